@@ -0,0 +1,153 @@
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import threading
+import argparse
+import json
+import time
+import bz2
+import os
+import re
+from get_last_run import get_url_paths
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('url', help='URL of the directory listing containing the files')
+parser.add_argument('pattern', help='Regular expression matching the names of the files to download')
+parser.add_argument('-o', '--output_folder', help='Folder where the decompressed files are written',
+                    required=False, default='.')
+parser.add_argument('-j', '--max_workers', help='Maximum number of concurrent downloads',
+                    required=False, default=10, type=int)
+parser.add_argument('-H', '--max_per_host', help='Maximum number of concurrent downloads per host',
+                    required=False, default=5, type=int)
+parser.add_argument('-r', '--max_retries', help='Number of attempts for every file',
+                    required=False, default=3, type=int)
+parser.add_argument('-s', '--stats_file', help='JSON file where the statistics of every file are written',
+                    required=False, default=None)
+
+
+class Downloader():
+    """Download .bz2 files over a pool of HTTP connections, decompressing
+    them on the fly straight to disk. Every file is first written as .part and
+    renamed only once it is complete, so that a new call after a partial
+    failure only downloads the files that are missing."""
+
+    def __init__(self, output_folder='.', max_workers=10, max_per_host=5,
+                 max_retries=3, timeout=60, chunk_size=1 << 20):
+        self.output_folder = output_folder
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._host_slots = {}
+        self._lock = threading.Lock()
+
+    def _host_slot(self, url):
+        """Semaphore bounding the concurrent downloads from the host of url"""
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._host_slots[host]
+
+    def _fetch_once(self, url, filename):
+        tmp_file = filename + '.part'
+        with self._host_slot(url):
+            start = time.perf_counter()
+            with self.session.get(url, stream=True, timeout=self.timeout) as response:
+                response.raise_for_status()
+                latency = time.perf_counter() - start
+                decompressor = bz2.BZ2Decompressor()
+                nbytes = 0
+                with open(tmp_file, 'wb') as f:
+                    for chunk in response.iter_content(self.chunk_size):
+                        nbytes += len(chunk)
+                        # bzip2 files can be made of several concatenated streams
+                        while chunk:
+                            if decompressor.eof:
+                                decompressor = bz2.BZ2Decompressor()
+                            f.write(decompressor.decompress(chunk))
+                            chunk = decompressor.unused_data if decompressor.eof else b''
+                expected = response.headers.get('Content-Length')
+            elapsed = time.perf_counter() - start
+
+        if expected is not None and int(expected) != nbytes:
+            raise IOError('Truncated download, got %d of %s bytes' % (nbytes, expected))
+        # The end of stream is only reached if all the block CRCs matched
+        if not decompressor.eof:
+            raise EOFError('Compressed stream ended before the end-of-stream marker')
+        os.replace(tmp_file, filename)
+
+        return {'latency': latency, 'elapsed': elapsed, 'bytes': nbytes,
+                'bytes_out': os.path.getsize(filename),
+                'throughput': nbytes / elapsed if elapsed > 0 else None}
+
+    def fetch(self, url):
+        """Download and decompress a single url, returns its statistics"""
+        filename = os.path.join(self.output_folder,
+                                os.path.basename(url).replace('.bz2', ''))
+        stats = {'url': url, 'file': filename}
+        if os.path.isfile(filename):
+            stats['status'] = 'skipped'
+            return stats
+
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                stats.update(self._fetch_once(url, filename))
+                stats.update({'status': 'ok', 'attempts': attempt})
+                return stats
+            except (requests.RequestException, OSError, EOFError) as e:
+                stats['error'] = str(e)
+                if attempt < self.max_retries:
+                    time.sleep(min(2 ** attempt, 30))
+
+        if os.path.isfile(filename + '.part'):
+            os.remove(filename + '.part')
+        stats.update({'status': 'failed', 'attempts': self.max_retries})
+        return stats
+
+    def download(self, urls):
+        """Download all urls concurrently, returns the list of statistics"""
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(self.fetch, urls))
+
+
+def print_stats(stats):
+    for s in stats:
+        if s['status'] == 'ok':
+            print('%s : %.2f s (latency %.2f s), %.1f MB at %.1f MB/s' %
+                  (os.path.basename(s['file']), s['elapsed'], s['latency'],
+                   s['bytes'] / 1e6, (s['throughput'] or 0) / 1e6))
+        elif s['status'] == 'failed':
+            print('%s : FAILED after %d attempts (%s)' %
+                  (os.path.basename(s['file']), s['attempts'], s['error']))
+    ok = [s for s in stats if s['status'] == 'ok']
+    print('Downloaded %d files (%.1f MB), skipped %d, failed %d' %
+          (len(ok), sum(s['bytes'] for s in ok) / 1e6,
+           sum(s['status'] == 'skipped' for s in stats),
+           sum(s['status'] == 'failed' for s in stats)))
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    pattern = re.compile(args.pattern)
+    urls = [url for url in get_url_paths(args.url, '.bz2')
+            if pattern.search(os.path.basename(url))]
+
+    downloader = Downloader(output_folder=args.output_folder,
+                            max_workers=args.max_workers,
+                            max_per_host=args.max_per_host,
+                            max_retries=args.max_retries)
+    stats = downloader.download(urls)
+    print_stats(stats)
+    if args.stats_file:
+        with open(args.stats_file, 'w') as f:
+            json.dump(stats, f, indent=1)
+    if any(s['status'] == 'failed' for s in stats):
+        exit(1)
@@ -1,49 +1,23 @@
-listurls() {
-	filename="$1"
-	url="$2"
-	wget -qO- $url | grep -Eoi '<a [^>]+>' | \
-	grep -Eo 'href="[^\"]+"' | \
-	grep -Eo $filename | \
-	xargs -I {} echo "$url"{}
-}
-export -f listurls
-#
-get_and_extract_one() {
-  url="$1"
-  file=`basename $url | sed 's/\.bz2//g'`
-  if [ ! -f "$file" ]; then
-  	wget -t 2 -q -O - "$url" | bzip2 -dc > "$file"
-  fi
-}
-export -f get_and_extract_one
 ##############################################
-download_merge_2d_variable_icon_eu_eps()
+download_2d_variable_icon_eu_eps()
 {
-	filename="icon-eu-eps_europe_icosahedral_single-level_${year}${month}${day}${run}_*_${1}.grib2"
 	filename_grep="icon-eu-eps_europe_icosahedral_single-level_${year}${month}${day}${run}_(.*)_${1}.grib2.bz2"
 	url="https://opendata.dwd.de/weather/nwp/icon-eu-eps/grib/${run}/${1}/"
-	if [ ! -f "${1}_${year}${month}${day}${run}_eur.nc" ]; then
-		listurls $filename_grep $url | parallel -j 5 get_and_extract_one {}
-		find ${filename} -empty -type f -delete # Remove empty files
-		cdo mergetime ${filename} ${1}_${year}${month}${day}${run}_eur.grib2
-		rm ${filename}
-	fi
+	# Files already on disk are skipped, the single steps are kept as they
+	# are and concatenated when they're read
+	python ${HOME_FOLDER}/download_dwd.py "$url" "$filename_grep" -H 5
 }
-export -f download_merge_2d_variable_icon_eu_eps
+export -f download_2d_variable_icon_eu_eps
 ##############################################
-download_merge_3d_variable_icon_eu_eps()
+download_3d_variable_icon_eu_eps()
 {
-	filename="icon-eu-eps_europe_icosahedral_pressure-level_${year}${month}${day}${run}_*_${1}.grib2"
 	filename_grep="icon-eu-eps_europe_icosahedral_pressure-level_${year}${month}${day}${run}_(.*)_850_${1}.grib2.bz2"
 	url="https://opendata.dwd.de/weather/nwp/icon-eu-eps/grib/${run}/${1}/"
-	if [ ! -f "${1}_${year}${month}${day}${run}_eur.nc" ]; then
-		listurls $filename_grep $url | parallel -j 5 get_and_extract_one {}
-		find ${filename} -empty -type f -delete # Remove empty files
-		cdo mergetime ${filename} ${1}_${year}${month}${day}${run}_eur.grib2
-		rm ${filename}
-	fi
+	# Files already on disk are skipped, the single steps are kept as they
+	# are and concatenated when they're read
+	python ${HOME_FOLDER}/download_dwd.py "$url" "$filename_grep" -H 5
 }
-export -f download_merge_3d_variable_icon_eu_eps
+export -f download_3d_variable_icon_eu_eps
 ################################################
 download_invariant_icon_eu_eps()
 {
@@ -1,8 +1,18 @@
 from datetime import datetime, timedelta
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import argparse
+import hashlib
+import tempfile
+import json
+import time
+import sys
+import os
+import re
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plotting'))
+from utils import atomic_write
 
 
 parser = argparse.ArgumentParser()
@@ -14,8 +24,10 @@ parser.add_argument('-v3d', '--vars_3d', help='List of 3d variables to be checke
                     required=False, default=None, nargs='+')
 parser.add_argument('-l', '--levels_3d', help='List of 3d levels to be checked',
                     required=False, default=None, nargs='+')
-
-args = parser.parse_args()
+parser.add_argument('-p', '--partial', help='Return the most recent run with at least one file available',
+                    required=False, action='store_true')
+parser.add_argument('-t', '--cache_ttl', help='Seconds for which a directory listing is cached',
+                    required=False, default=60, type=int)
 
 var_2d_list = ['aswdifd_s', 'aswdifu_s',
                'athb_s', 'cape_ml', 'clch', 'clcl', 'clcm', 'clct',
@@ -27,30 +39,64 @@ var_2d_list = ['aswdifd_s', 'aswdifu_s',
 
 var_3d_list = ['fi', 'qv', 't', 'u', 'v']
 
+# Forecast steps (hours) uploaded for every run
+f_times = list(range(0, 49)) + list(range(51, 73, 3)) + list(range(78, 121, 6))
+
+
+# Shared session so that all the listings reuse the same connections
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=32))
+
+href_regex = re.compile(r'href="([^"]+)"')
+cache_folder = os.path.join(tempfile.gettempdir(), 'icon_eu_eps_listings')
+
 
-def get_url_paths(url, ext='', prefix='', params={}):
-    response = requests.get(url, params=params)
-    if response.ok:
-        response_text = response.text
+def get_url_paths(url, ext='', prefix='', params={}, cache_ttl=0):
+    """Return the links in the directory listing at url ending with ext and
+    starting with prefix. If cache_ttl > 0 the links are read from/written to
+    a local cache which is valid for cache_ttl seconds."""
+    cache_file = os.path.join(cache_folder, hashlib.sha1(
+        (url + json.dumps(params, sort_keys=True)).encode()).hexdigest() + '.json')
+    if cache_ttl > 0 and os.path.isfile(cache_file) and \
+            time.time() - os.path.getmtime(cache_file) < cache_ttl:
+        with open(cache_file) as f:
+            hrefs = json.load(f)
     else:
-        return response.raise_for_status()
-    soup = BeautifulSoup(response_text, 'html.parser')
-    parent = [url + node.get('href') for node in soup.find_all('a') if (
-        node.get('href').endswith(ext)) & (node.get('href').startswith(prefix))]
+        response = session.get(url, params=params)
+        if response.ok:
+            response_text = response.text
+        else:
+            return response.raise_for_status()
+        # The listing is a flat list of links, no need to build the whole tree
+        hrefs = href_regex.findall(response_text)
+        if cache_ttl > 0:
+            os.makedirs(cache_folder, exist_ok=True)
+            with atomic_write(cache_file) as f:
+                json.dump(hrefs, f)
+
+    parent = [url + href for href in hrefs if (
+        href.endswith(ext)) & (href.startswith(prefix))]
     return parent
 
 
+def get_listings(urls, ext='', prefix='', cache_ttl=0):
+    """Fetch all the directory listings at urls concurrently, returns a
+    dictionary url -> links (see get_url_paths)"""
+    urls = list(set(urls))
+    with ThreadPoolExecutor(max_workers=max(len(urls), 1)) as executor:
+        paths = executor.map(lambda url: get_url_paths(url, ext, prefix=prefix,
+                                                       cache_ttl=cache_ttl), urls)
+        return dict(zip(urls, paths))
+
+
 def find_file_name(vars_2d=None,
                    vars_3d=None,
                    levels_3d=None,
                    base_url="https://opendata.dwd.de/weather/nwp",
                    model_url="icon-eu-eps/grib",
                    date_string=None,
-                   run_string=None):
-    f_times = list(range(0, 49)) + list(range(51, 73, 3)) + list(range(78, 121, 6))
-    #
-    if type(f_times) is not list:
-        f_times = [f_times]
+                   run_string=None,
+                   listings=None):
     if (vars_2d is None) and (vars_3d is None):
         raise ValueError(
             'You need to specify at least one 2D or one 3D variable')
@@ -82,8 +128,11 @@ def find_file_name(vars_2d=None,
                 urls_to_check.append("%s/%s/%s/%s/%s_%s%s_%03d_%s.grib2.bz2" %
                                      (base_url, model_url, run_string, var,
                                       var_url, date_string, run_string, f_time, var))
-            urls_on_server = get_url_paths("%s/%s/%s/%s/" % (base_url, model_url, run_string, var),
-                                           'grib2.bz2', prefix=var_url)
+            var_dir = "%s/%s/%s/%s/" % (base_url, model_url, run_string, var)
+            if listings is not None and var_dir in listings:
+                urls_on_server = listings[var_dir]
+            else:
+                urls_on_server = get_url_paths(var_dir, 'grib2.bz2', prefix=var_url)
             if set(urls_to_check).issubset(urls_on_server):
                 data['status'].append('all files available')
                 data['avail_tsteps'].append(len(urls_to_check))
@@ -108,8 +157,11 @@ def find_file_name(vars_2d=None,
                     urls_to_check.append("%s/%s/%s/%s/%s_%s%s_%03d_%s_%s.grib2.bz2" %
                                          (base_url, model_url, run_string, var,
                                           var_url, date_string, run_string, f_time, plev, var))
-            urls_on_server = get_url_paths("%s/%s/%s/%s/" % (base_url, model_url, run_string, var),
-                                           'grib2.bz2', prefix=var_url)
+            var_dir = "%s/%s/%s/%s/" % (base_url, model_url, run_string, var)
+            if listings is not None and var_dir in listings:
+                urls_on_server = listings[var_dir]
+            else:
+                urls_on_server = get_url_paths(var_dir, 'grib2.bz2', prefix=var_url)
             if set(urls_to_check).issubset(urls_on_server):
                 data['status'].append('all files available')
                 data['avail_tsteps'].append(len(urls_to_check))
@@ -127,7 +179,9 @@ def find_file_name(vars_2d=None,
 
 
 def get_most_recent_run(run=None, vars_2d=['t_2m'], vars_3d=None,
-                        levels_3d=None):
+                        levels_3d=None, cache_ttl=0, partial=False,
+                        base_url="https://opendata.dwd.de/weather/nwp",
+                        model_url="icon-eu-eps/grib"):
     today_string = datetime.now().strftime('%Y%m%d')
     yesterday_string = (datetime.today() -
                         timedelta(days=1)).strftime('%Y%m%d')
@@ -135,20 +189,35 @@ def get_most_recent_run(run=None, vars_2d=['t_2m'], vars_3d=None,
         runs = ['00', '06', '12', '18']
     else:
         runs = [run]
+    # The directory of a run/variable is the same for every day, so every
+    # listing is fetched only once and all of them at the same time
+    variables = (vars_2d or []) + (vars_3d or [])
+    listings = get_listings(["%s/%s/%s/%s/" % (base_url, model_url, run_string, var)
+                             for run_string in runs for var in variables],
+                            'grib2.bz2', prefix='icon-eu-eps_europe_icosahedral',
+                            cache_ttl=cache_ttl)
     temp = []
     for date_string in [yesterday_string, today_string]:
         for run_string in runs:
             temp.append(find_file_name(vars_2d=vars_2d,
                                        vars_3d=vars_3d,
                                        levels_3d=levels_3d,
+                                       base_url=base_url,
+                                       model_url=model_url,
                                        date_string=date_string,
-                                       run_string=run_string))
+                                       run_string=run_string,
+                                       listings=listings))
     final = pd.concat(temp)
-    sel_run = final.loc[final.status == 'all files available', 'run'].max()
+    if partial:
+        sel_run = final.loc[final.avail_tsteps > 0, 'run'].max()
+    else:
+        sel_run = final.loc[final.status == 'all files available', 'run'].max()
     return final, sel_run
 
 
 if __name__ == "__main__":
+    args = parser.parse_args()
     final, sel_run = get_most_recent_run(run=args.run, vars_2d=args.vars_2d,
-                        vars_3d=args.vars_3d, levels_3d=args.levels_3d)
+                        vars_3d=args.vars_3d, levels_3d=args.levels_3d,
+                        cache_ttl=args.cache_ttl, partial=args.partial)
     print(sel_run)
@@ -0,0 +1,103 @@
+import utils
+import os
+import sys
+import time
+import shutil
+import tracemalloc
+import numpy as np
+import xarray as xr
+import dask.array
+
+# Compare the chunk profiles in utils.chunk_profiles with the old layout, in
+# which every member was a separate chunk, on the probability of a single
+# variable over the whole domain. Every layout is read from a zarr store
+# written with its own chunks (as convert_grib.py does for 'members'), and
+# the old layout also straight from the GRIB files with cfgrib, as it was
+# read before the conversion stage. For every case print the number of
+# chunks and tasks of the dask graph, the time taken and the peak memory
+# allocated while computing it.
+#
+#   python benchmark_chunks.py [variable] [field] [threshold] [--synthetic]
+#
+# --synthetic uses random data with the shape of one variable of a run
+# (40 members, 65 steps, 75948 cells) instead of the downloaded files.
+# Results with --synthetic on a single CPU:
+#
+#   layout                  chunks    tasks  time [s]    peak [MB]
+#   members                     65      261      3.99         80.1
+#   points                       6       25      4.47        427.6
+#   single member (store)     2600     8711     37.74        106.5
+#
+# One chunk per member needs 40 times the chunks, each of them read and
+# decompressed separately, and 33 times the tasks, for 9 times the time,
+# while keeping all the members of a step together doesn't need more memory.
+
+arguments = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+if not arguments:
+    var, field, threshold = 'tot_prec', 'tp', 10.
+else:
+    var, field, threshold = arguments[0], arguments[1], float(arguments[2])
+synthetic = '--synthetic' in sys.argv[1:]
+
+# Layout of the stores before convert_grib.py, one chunk for every member
+single_member = {'number': 1, 'step': 1, 'values': -1}
+layouts = dict(utils.chunk_profiles)
+layouts['single member (store)'] = single_member
+
+def open_source():
+    """Dataset with field to be written in every layout"""
+    if not synthetic:
+        return utils.read_grib(var)
+    shape = {'number': 40, 'step': 65, 'values': 75948}
+    data = dask.array.random.random(tuple(shape.values()), chunks=(-1, 1, -1))
+    return xr.Dataset({field: (tuple(shape), (data * 2 * threshold).astype(np.float32))},
+                      coords={'number': np.arange(1, shape['number'] + 1),
+                              'step': np.arange(shape['step'])})
+
+
+def write_store(source, name, chunks):
+    store = os.path.join(utils.folder, 'benchmark_%s.zarr' % name.split()[0])
+    ds = source[[field]].chunk(utils.get_chunks(chunks))
+    for v in ds.variables.values():
+        v.encoding = {}
+    # Same compression as the store written by convert_grib.py
+    ds.to_zarr(store, mode='w', encoding=utils.store_encoding([field]))
+    return store
+
+
+def benchmark(da):
+    prob = (da > threshold).mean('number')
+    n_tasks = len(prob.data.__dask_graph__())
+
+    tracemalloc.start()
+    start_time = time.time()
+    utils.compute_probabilities(da, [threshold])
+    elapsed_time = time.time() - start_time
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'chunks': da.data.npartitions, 'tasks': n_tasks,
+            'time': elapsed_time, 'peak': peak}
+
+
+def print_result(name, res):
+    print('%-22s %8d %8d %9.2f %12.1f' % (name, res['chunks'], res['tasks'],
+                                          res['time'], res['peak'] / 1e6))
+
+
+def main():
+    source = open_source()
+    print('%-22s %8s %8s %9s %12s' % ('layout', 'chunks', 'tasks', 'time [s]', 'peak [MB]'))
+    for name, chunks in layouts.items():
+        store = write_store(source, name, chunks)
+        try:
+            print_result(name, benchmark(xr.open_zarr(store, chunks=utils.get_chunks(chunks))[field]))
+        finally:
+            shutil.rmtree(store)
+    if not synthetic:
+        print_result('single member (GRIB)', benchmark(utils.read_grib(var, chunks=single_member)[field]))
+
+
+if __name__ == "__main__":
+    utils.print_message('Starting benchmark of the chunk layouts on ' + var)
+    main()
@@ -0,0 +1,46 @@
+import utils
+import sys
+
+# Decode every downloaded variable only once per run and write it into
+# a chunked, compressed zarr store (utils.store_file). All the plotting
+# scripts then open this store lazily through utils.read_dataset
+# instead of running cfgrib on the same GRIB files over and over.
+
+utils.print_message('Starting conversion of GRIB files')
+
+if not sys.argv[1:]:
+    variables = ['t_2m', 'clct', 'snow_gsp', 'snow_con',
+                 'tot_prec', 'vmax_10m', 'u_10m', 'v_10m']
+else:
+    variables = sys.argv[1:]
+
+
+def main():
+    for var in variables:
+        try:
+            dset = utils.read_grib(var)
+        except OSError:
+            utils.print_message('WARNING: no files found for %s' % var)
+            continue
+        # Drop the GRIB encoding, the store only keeps the chunking
+        # used by read_dataset (all members of a step in one chunk)
+        for v in dset.variables.values():
+            v.encoding = {}
+        dset.to_zarr(utils.store_file, group=var, mode='w',
+                     encoding=utils.store_encoding(dset.data_vars), consolidated=True)
+        utils.print_message('Converted %s' % var)
+    # Cache the cell index and remapping weights (see run_all.py --regrid)
+    # of every region while we're at it
+    for region in utils.proj_defs:
+        utils.get_region_index(region)
+        utils.get_regrid_weights(region)
+    utils.get_grid_tree()
+
+
+if __name__ == "__main__":
+    import time
+    start_time = time.time()
+    main()
+    elapsed_time = time.time()-start_time
+    utils.print_message(
+        "script took " + time.strftime("%H:%M:%S", time.gmtime(elapsed_time)))
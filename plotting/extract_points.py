@@ -0,0 +1,42 @@
+import utils
+import sys
+from glob import glob
+
+# Extract the time series of every member and variable in the grid cells
+# nearest to the cities we produce meteograms for, in a single pass over the
+# full domain. These are written to a small point store (utils.points_file,
+# one group per city) so that plot_meteogram.py never has to read the full
+# domain again.
+
+utils.print_message('Starting extraction of points')
+
+if not sys.argv[1:]:
+    utils.print_message('Cities not defined, falling back to default (Hamburg)')
+    cities = ['Hamburg']
+else:
+    cities = sys.argv[1:]
+
+
+def main():
+    variables = []
+    for var in utils.point_variables:
+        if utils.in_store(var) or glob(f"{utils.folder}/*_{var}.grib2"):
+            variables.append(var)
+        else:
+            utils.print_message('WARNING: no files found for %s' % var)
+    if not variables:
+        return
+    for dset in utils.extract_points(cities, variables):
+        for v in dset.variables.values():
+            v.encoding = {}
+        dset.to_zarr(utils.points_file, group=dset.attrs['city'], mode='w')
+        utils.print_message('Extracted %s' % dset.attrs['city'])
+
+
+if __name__ == "__main__":
+    import time
+    start_time = time.time()
+    main()
+    elapsed_time = time.time()-start_time
+    utils.print_message(
+        "script took " + time.strftime("%H:%M:%S", time.gmtime(elapsed_time)))
@@ -0,0 +1,30 @@
+import utils
+import sys
+from glob import glob
+from multiprocessing import Pool
+
+# Build the cfgrib index of every downloaded GRIB file once, right after the
+# download, into utils.index_folder. The plotting scripts running afterwards
+# (and at the same time) then only read these indices instead of scanning
+# every file again in each process.
+
+if not sys.argv[1:]:
+    files = sorted(glob(utils.folder + '/*.grib2'))
+else:
+    files = sys.argv[1:]
+
+
+def main():
+    with Pool(utils.processes) as pool:
+        pool.map(utils.build_grib_index, files, chunksize=1)
+    utils.print_message('Indexed %d GRIB files' % len(files))
+
+
+if __name__ == "__main__":
+    import time
+    utils.print_message('Starting indexing of GRIB files')
+    start_time = time.time()
+    main()
+    elapsed_time = time.time()-start_time
+    utils.print_message(
+        "script took " + time.strftime("%H:%M:%S", time.gmtime(elapsed_time)))
@@ -0,0 +1,112 @@
+import utils
+import sys
+import os
+import re
+import json
+import numpy as np
+from glob import glob
+from multiprocessing import Pool
+from PIL import Image
+
+# Pack all the steps of every product and region (prob_prec_50_<hour>.png...)
+# into a single file with a small JSON index, so that the web page fetches
+# (and we upload) one file per product instead of one for every step.
+# Formats are
+#   sprite : all frames tiled in palette PNG sheets (<product>.<sheet>.sprite.png)
+#            of at most max_sheet_size pixels per side
+#   webp   : lossless animated WebP (<product>.webp)
+# The index <product>.json lists the hour of every frame and its position
+# (and for sprites the sheet it is in).
+#
+#   python pack_frames.py [sprite|webp] [--remove]
+
+if not sys.argv[1:]:
+    pack_format = 'sprite'
+else:
+    pack_format = sys.argv[1]
+# Remove the single frames once packed
+remove_frames = '--remove' in sys.argv[2:]
+
+# Duration of every frame in the animated WebP, in milliseconds
+frame_duration = 500
+# Maximum width and height of a sprite sheet: browsers (mostly on mobile)
+# limit the size of a decoded image, so the frames are split over many sheets
+max_sheet_size = 4096
+
+frame_regex = re.compile(r'^(?P<product>.+)_(?P<hour>\d+)\.(png|webp)$')
+
+
+def find_products():
+    """Return a dict (folder, product) -> list of (hour, file) sorted by hour"""
+    products = {}
+    for folder in set(utils.subfolder_images.values()):
+        for file in glob(os.path.join(folder, 'prob_*')):
+            match = frame_regex.match(os.path.basename(file))
+            if match:
+                products.setdefault((folder, match['product']), []).append(
+                    (int(match['hour']), file))
+    return {key: sorted(frames) for key, frames in products.items()}
+
+
+def pack(job):
+    (folder, product), frames = job
+    images = [Image.open(file).convert('RGB') for _, file in frames]
+    width = max(image.width for image in images)
+    height = max(image.height for image in images)
+    index = {'format': pack_format, 'width': width, 'height': height, 'frames': []}
+
+    if pack_format == 'webp':
+        index['file'] = product + '.webp'
+        index['duration'] = frame_duration
+        index['frames'] = [{'hour': hour} for hour, _ in frames]
+        images[0].save(os.path.join(folder, index['file']), format='WEBP', save_all=True,
+                       append_images=images[1:], duration=frame_duration, loop=0,
+                       lossless=True, method=6)
+    else:
+        max_columns = max(1, max_sheet_size // width)
+        max_rows = max(1, max_sheet_size // height)
+        n_sheets = int(np.ceil(len(images) / (max_columns * max_rows)))
+        index['files'] = []
+        for sheet_number, sheet_frames in enumerate(
+                np.array_split(np.arange(len(images)), n_sheets)):
+            # As square as possible within the maximum size
+            columns = min(max_columns, max(int(np.ceil(len(sheet_frames) / max_rows)),
+                                           int(np.ceil(np.sqrt(len(sheet_frames))))))
+            rows = int(np.ceil(len(sheet_frames) / columns))
+            sheet = Image.new('RGB', (columns * width, rows * height), 'white')
+            for i, frame in enumerate(sheet_frames):
+                x, y = (i % columns) * width, (i // columns) * height
+                sheet.paste(images[frame], (x, y))
+                index['frames'].append({'hour': frames[frame][0], 'sheet': sheet_number,
+                                        'x': x, 'y': y})
+            sheet_file = '%s.%d.sprite.png' % (product, sheet_number)
+            sheet = sheet.quantize(colors=256, method=Image.Quantize.FASTOCTREE,
+                                   dither=Image.Dither.NONE)
+            sheet.save(os.path.join(folder, sheet_file), format='PNG', optimize=True)
+            index['files'].append(sheet_file)
+
+    with open(os.path.join(folder, product + '.json'), 'w') as f:
+        json.dump(index, f)
+
+    if remove_frames:
+        for _, file in frames:
+            os.remove(file)
+
+    return len(frames)
+
+
+def main():
+    products = find_products()
+    with Pool(utils.processes) as pool:
+        n_frames = sum(pool.map(pack, products.items(), chunksize=1))
+    utils.print_message('Packed %d frames, %d products' % (n_frames, len(products)))
+
+
+if __name__ == "__main__":
+    import time
+    utils.print_message('Starting packing of frames as ' + pack_format)
+    start_time = time.time()
+    main()
+    elapsed_time = time.time()-start_time
+    utils.print_message(
+        "script took " + time.strftime("%H:%M:%S", time.gmtime(elapsed_time)))
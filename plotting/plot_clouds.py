@@ -1,7 +1,5 @@
 import matplotlib.pyplot as plt
 import numpy as np
-from multiprocessing import Pool
-from functools import partial
 import utils
 import sys
 
@@ -13,24 +11,19 @@ if not debug:
 
 # The one employed for the figure name when exported
 variable_name = 'prob_clouds'
+# Variables to be read with utils.LazyDataset
+variables = ['clct']
 
-utils.print_message('Starting script to plot '+variable_name)
 
-# Get the projection as system argument from the call so that we can
-# span multiple instances of this script outside
-if not sys.argv[1:]:
-    utils.print_message(
-        'Projection not defined, falling back to default (de)')
-    projection = 'de'
-else:
-    projection = sys.argv[1]
+def compute(dset):
+    """Probability of cloud cover exceeding 50%"""
+    out = utils.compute_probabilities(dset['CLCT'], [50])
+    return out['prob'].sel(threshold=50, drop=True).to_dataset(name='prob_cloudy')
 
 
-def main():
-    dset = utils.read_dataset(['clct'], region=projection)
-    dset['prob_cloudy'] = ((dset.CLCT > 50).sum(
-        dim='number') / len(dset.number)) * 100
-
+def setup(dset, projection):
+    """Create the figure with the static part of the frames on projection,
+    returns the arguments of plot_files"""
     levels = np.linspace(10, 100, 10)
     cmap = utils.get_colormap("sky")
 
@@ -38,39 +31,49 @@ def main():
 
     ax = plt.gca()
     m, x, y = utils.get_projection(dset, projection, labels=True)
+    triang = utils.get_triangulation(x, y, projection)
     m.fillcontinents(color='lightgray', lake_color='whitesmoke', zorder=0)
 
-    dset = dset.drop(['CLCT','clon','clat']).load()
-
     # All the arguments that need to be passed to the plotting function
-    args = dict(x=x, y=y, ax=ax, levels=levels, cmap=cmap)
+    return dict(triang=triang, ax=ax, levels=levels, cmap=cmap,
+                projection=projection)
+
+
+def plot(dset, projection, scheduler):
+    """Submit the frames on projection to scheduler. The figure is only
+    created the first time for every projection"""
+    ds = dset.drop_vars(['clon', 'clat'], errors='ignore')
 
-    utils.print_message('Pre-processing finished, launching plotting scripts')
     if debug:
-        plot_files(dset.isel(step=slice(0, 2)), **args)
+        plot_files(ds.isel(step=slice(0, 2)), **setup(dset, projection))
     else:
-        # Parallelize the plotting by dividing into chunks and processes
-        dss = utils.chunks_dataset(dset, utils.chunks_size)
-        plot_files_param = partial(plot_files, **args)
-        p = Pool(utils.processes)
-        p.map(plot_files_param, dss)
+        # Every step is rendered as a separate frame by the pool of workers
+        scheduler.submit(plot_files, ds, key=(variable_name, projection),
+                         setup=lambda: setup(dset, projection))
+
+
+def main(projection):
+    # Only the variables used by compute are opened
+    dset = utils.LazyDataset(variables, region=projection)
+    with utils.FrameScheduler() as scheduler:
+        plot(compute(dset), projection, scheduler)
 
 
 def plot_files(dss, **args):
-    first = True
+    renderer = utils.get_renderer(args['ax'].figure)
+    first = renderer.first
     for time_sel in dss.step:
         data = dss.sel(step=time_sel)
         time, run, cum_hour = utils.get_time_run_cum(data)
         # Build the name of the output image
-        filename = utils.subfolder_images[projection] + \
+        filename = utils.subfolder_images[args['projection']] + \
             '/' + variable_name + '_%s.png' % cum_hour
 
-        cs = args['ax'].tricontourf(args['x'],
-                                    args['y'],
-                                    data['prob_cloudy'],
-                                    extend='both',
-                                    cmap=args['cmap'],
-                                    levels=args['levels'])
+        cs = utils.contourf(args['ax'], args['triang'],
+                            data['prob_cloudy'],
+                            extend='both',
+                            cmap=args['cmap'],
+                            levels=args['levels'])
 
         an_fc = utils.annotation_forecast(args['ax'], time)
         an_var = utils.annotation(
@@ -78,13 +81,13 @@ def plot_files(dss, **args):
         an_run = utils.annotation_run(args['ax'], run)
 
         if first:
-            plt.colorbar(cs, orientation='horizontal', label='Probability [%]',
-                         fraction=0.04, pad=0.04)
+            args['ax'].figure.colorbar(cs, ax=args['ax'], orientation='horizontal',
+                                       label='Probability [%]', fraction=0.04, pad=0.04)
 
         if debug:
             plt.show(block=True)
         else:
-            plt.savefig(filename, **utils.options_savefig)
+            renderer.save(filename, [cs, an_fc, an_var, an_run])
 
         utils.remove_collections([cs, an_fc, an_var, an_run])
 
@@ -93,8 +96,19 @@ def plot_files(dss, **args):
 
 if __name__ == "__main__":
     import time
+    utils.print_message('Starting script to plot '+variable_name)
+
+    # Get the projection as system argument from the call so that we can
+    # span multiple instances of this script outside
+    if not sys.argv[1:]:
+        utils.print_message(
+            'Projection not defined, falling back to default (de)')
+        projection = 'de'
+    else:
+        projection = sys.argv[1]
+
     start_time = time.time()
-    main()
+    main(projection)
     elapsed_time = time.time()-start_time
     utils.print_message("script took " + time.strftime("%H:%M:%S",
                                                        time.gmtime(elapsed_time)))
@@ -1,12 +1,16 @@
 import time
 from tqdm.contrib.concurrent import process_map
 import sys
-from utils import get_city_coordinates, read_dataset, processes, folder_images, convert_timezone
+from utils import read_points, processes, folder_images, convert_timezone, accumulated_to_rate
 import matplotlib.dates as mdates
 import seaborn as sns
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib import gridspec
+from matplotlib.collections import PolyCollection, PathCollection
+from matplotlib.font_manager import FontProperties
+from matplotlib.textpath import TextPath
+from matplotlib.transforms import Affine2D
 import pandas as pd
 import matplotlib
 matplotlib.use('Agg')
@@ -24,38 +28,27 @@ else:
 
 
 def main():
-    ds = read_dataset(vars=['t_2m', 'tot_prec',
-                            'snow_gsp', 'snow_con', 'clct'])
-    ds['snow_rate'] = (ds['lssrwe'] + ds['csrwe']).differentiate(coord="step", datetime_unit="h")
-    # we use total prec for this
-    ds['rain_rate'] = ds['tp'].differentiate(coord="step", datetime_unit="h")
+    it = []
+    for ds in read_points(cities):
+        ds['snow_rate'] = accumulated_to_rate(ds['lssrwe'] + ds['csrwe'])
+        # we use total prec for this
+        ds['rain_rate'] = accumulated_to_rate(ds['tp'])
+        it.append(ds.drop(['lssrwe', 'csrwe', 'tp']))
 
-    lons, lats = np.deg2rad(ds.clon), np.deg2rad(ds.clat)
+    # Large chunks so that every worker reuses its figure template for many cities
+    process_map(plot, it, max_workers=processes,
+                chunksize=max(1, len(it) // (processes * 4)))
 
-    it = []
-    for city in cities:
-        lon, lat = get_city_coordinates(city)
-        # Find closest point with haversine distance
-        dlon = np.deg2rad(lon) - lons
-        dlat = np.deg2rad(lat) - lats
-        a = np.sin(dlat/2.0)**2 + np.cos(lats) * \
-            np.cos(np.deg2rad(lat)) * np.sin(dlon/2.0)**2
-        c = 2 * np.arcsin(np.sqrt(a))
-        km = 6367 * c
-        sel = np.argmin(km.values)
-        d = ds.drop(['lssrwe', 'csrwe','tp']).isel(cell=sel).compute()
-        d.attrs['city'] = city
-        it.append(d)
-
-    process_map(plot, it, max_workers=processes, chunksize=2)
 
+_template = None
 
-def plot(dset_city):
-    city = dset_city.attrs['city']
-    print('Producing meteogram for %s' % city)
-    dset_city['t2m'] = dset_city['t2m'].metpy.convert_units('degC').metpy.dequantify()
-    dset_city['valid_time'] = convert_timezone(
-        pd.to_datetime(dset_city.valid_time))
+
+def get_template():
+    """Figure, axes and formatting shared by all the meteograms produced by
+    this process. Only the data artists are replaced for every city."""
+    global _template
+    if _template is not None:
+        return _template
 
     nrows = 3
     ncols = 1
@@ -70,83 +63,123 @@ def plot(dset_city):
     gs = gridspec.GridSpec(nrows, ncols, height_ratios=[1, 1, 1])
 
     ax_temp = plt.subplot(gs[0])
-    ax_temp.set_title("ICON-EU-EPS meteogram for "+city+" | Run " +
-                      dset_city.time.dt.strftime('%Y%m%d %H UTC').item())
-    ax_temp.plot(dset_city['valid_time'],
-                 dset_city['t2m'].values.T, '-', linewidth=0.8, zorder=1)
-    ax_temp.set_xlim(dset_city['valid_time'][0], dset_city['valid_time'][-1])
-    ax_temp.xaxis.set_major_locator(locator)
-    ax_temp.xaxis.set_major_formatter(formatter)
-    ax_temp.yaxis.grid(True)
-    ax_temp.xaxis.grid(True, color='gray', linewidth=0.2)
-    ax_temp.tick_params(axis='y', which='major', labelsize=8)
     ax_temp.tick_params(axis='x', which='both',
                         bottom=False, labelbottom=False)
     ax_temp.set_ylabel("2m temperature", fontsize=8)
 
     ax_prec = plt.subplot(gs[1])
-    widths = np.concatenate([np.full(49, 0.035), np.full(8,0.1), np.full(8, 0.2)])
-    for member in range(1, len(dset_city.number)):
-        ax_prec.bar(dset_city['valid_time'],
-                    dset_city.rain_rate.sel(number=member).values, width=widths,
-                    alpha=0.2, color='blue', zorder=1)
-        ax_prec.bar(dset_city['valid_time'],
-                    dset_city.snow_rate.sel(number=member).values, width=widths,
-                    alpha=0.2, color='purple', zorder=2)
-
-    # Add text on top of the bars
-    y_max = dset_city['rain_rate'].max(dim='number')
-    x = dset_city['valid_time']
-    prob = ((dset_city['rain_rate'] > 0.1).sum(
-            dim='number') / len(dset_city.number)) * 100
-    for i, _ in enumerate(prob):
-        if prob[i] > 0:
-            ax_prec.annotate(
-                ("%d%%" % prob[i]),
-                (x[i], y_max[i]),
-                color='black',
-                weight='bold',
-                fontsize=6,
-                zorder=5,
-                horizontalalignment='center',
-                rotation=90)
-
-    ax_prec.yaxis.grid(True)
-    ax_prec.xaxis.grid(True, color='gray', linewidth=0.2)
-    ax_prec.set_ylim(bottom=0)
-    ax_prec.set_xlim(dset_city['valid_time'][0], dset_city['valid_time'][-1])
-    ax_prec.xaxis.set_major_locator(locator)
-    ax_prec.xaxis.set_major_formatter(formatter)
-    ax_prec.tick_params(axis='y', which='major', labelsize=8)
     ax_prec.tick_params(axis='x', which='both',
                         bottom=False, labelbottom=False)
     ax_prec.set_ylabel("Rain (blue) and snow (purple)", fontsize=8)
 
     ax_clouds = plt.subplot(gs[2])
-    ax_clouds.plot(dset_city['valid_time'],
-                   dset_city['CLCT'].values.T, 'o', zorder=1, markersize=5)
-    ax_clouds.plot(dset_city['valid_time'], dset_city['CLCT'].mean(dim='number'), '-',
-                   linewidth=2, zorder=2, color='black')
-    ax_clouds.yaxis.grid(True)
-    ax_clouds.xaxis.grid(True, color='gray', linewidth=0.2)
-    ax_clouds.set_ylim(bottom=0)
-    ax_clouds.set_xlim(dset_city['valid_time'][0], dset_city['valid_time'][-1])
-    ax_clouds.xaxis.set_major_locator(locator)
-    ax_clouds.xaxis.set_major_formatter(formatter)
-    for label in ax_clouds.get_xticklabels(which='major'):
-        label.set(rotation=90)
-    ax_clouds.tick_params(axis='y', which='major', labelsize=8)
-    ax_clouds.tick_params(axis='x', which='both', labelsize=8)
+    ax_clouds.tick_params(axis='x', which='both', labelsize=8, labelrotation=90)
     ax_clouds.set_ylabel("Cloud cover", fontsize=8)
 
-    ax_clouds.annotate('Grid point %3.1fN %3.1fE' % (dset_city.clat, dset_city.clon),
-                       xy=(0.7, -0.4), xycoords='axes fraction', color="gray")
-
+    for ax in [ax_temp, ax_prec, ax_clouds]:
+        ax.xaxis.set_major_locator(locator)
+        ax.xaxis.set_major_formatter(formatter)
+        ax.yaxis.grid(True)
+        ax.xaxis.grid(True, color='gray', linewidth=0.2)
+        ax.tick_params(axis='y', which='major', labelsize=8)
 
     fig.subplots_adjust(hspace=0.05)
 
-    plt.savefig(folder_images+"meteogram_"+city, dpi=100, bbox_inches='tight')
-    plt.clf()
+    _template = (fig, ax_temp, ax_prec, ax_clouds)
+    return _template
+
+
+def bar_collection(x, heights, widths, **kwargs):
+    """Draw the bars of all members (heights has shape members x steps)
+    as a single PolyCollection, skipping the empty ones."""
+    x, widths = np.broadcast_to(x, heights.shape), np.broadcast_to(widths, heights.shape)
+    mask = np.isfinite(heights) & (heights > 0)
+    left, right = (x - widths / 2.)[mask], (x + widths / 2.)[mask]
+    top, bottom = heights[mask], np.zeros(mask.sum())
+    verts = np.stack([np.column_stack([left, bottom]), np.column_stack([left, top]),
+                      np.column_stack([right, top]), np.column_stack([right, bottom])], axis=1)
+    return PolyCollection(verts, linewidths=0, **kwargs)
+
+
+_label_paths = {}
+
+
+def label_collection(fig, ax, x, y, labels, size=6, **kwargs):
+    """Draw all labels at x, y (data coordinates) as a single PathCollection,
+    placed as ax.text(rotation=90, horizontalalignment='center') would, instead
+    of one Text artist for each of them. The path of every label is only
+    computed once per process."""
+    paths = []
+    for label in labels:
+        if (label, size) not in _label_paths:
+            path = TextPath((0, 0), label, size=size, prop=FontProperties(weight='bold'))
+            (_, y0), (_, y1) = path.get_extents().get_points()
+            # Rotated by 90 degrees: starts at y and is centered on x
+            _label_paths[(label, size)] = path.transformed(
+                Affine2D().translate(0, -(y0 + y1) / 2.).rotate_deg(90))
+        paths.append(_label_paths[(label, size)])
+    # Paths are in points, offsets in data coordinates
+    return PathCollection(paths, offsets=np.column_stack([x, y]),
+                          offset_transform=ax.transData,
+                          transform=Affine2D().scale(1 / 72.) + fig.dpi_scale_trans,
+                          clip_on=False, **kwargs)
+
+
+def plot(dset_city):
+    city = dset_city.attrs['city']
+    print('Producing meteogram for %s' % city)
+    dset_city['t2m'] = dset_city['t2m'].metpy.convert_units('degC').metpy.dequantify()
+    dset_city['valid_time'] = convert_timezone(
+        pd.to_datetime(dset_city.valid_time))
+
+    fig, ax_temp, ax_prec, ax_clouds = get_template()
+    x = mdates.date2num(dset_city['valid_time'].values)
+    artists = []
+
+    ax_temp.set_title("ICON-EU-EPS meteogram for "+city+" | Run " +
+                      dset_city.time.dt.strftime('%Y%m%d %H UTC').item())
+    # Start from the same colors for every city
+    ax_temp.set_prop_cycle(None)
+    artists += ax_temp.plot(x, dset_city['t2m'].transpose('step', 'number').values, '-',
+                            linewidth=0.8, zorder=1)
+
+    widths = np.concatenate([np.full(49, 0.035), np.full(8, 0.1), np.full(8, 0.2)])[:len(x)]
+    rain = dset_city['rain_rate'].transpose('number', 'step').values
+    snow = dset_city['snow_rate'].transpose('number', 'step').values
+    artists.append(ax_prec.add_collection(bar_collection(x, rain, widths, facecolors='blue',
+                                                         alpha=0.2, zorder=1)))
+    artists.append(ax_prec.add_collection(bar_collection(x, snow, widths, facecolors='purple',
+                                                         alpha=0.2, zorder=2)))
+
+    # Add text on top of the bars
+    y_max = np.nanmax(rain, axis=0)
+    prob = (np.sum(rain > 0.1, axis=0) / rain.shape[0]) * 100
+    artists.append(ax_prec.add_collection(
+        label_collection(fig, ax_prec, x[prob > 0], y_max[prob > 0],
+                         ["%d%%" % p_i for p_i in prob[prob > 0]],
+                         facecolors='black', linewidths=0, zorder=5),
+        autolim=False))
+    ax_prec.set_ylim(0, max(np.nan_to_num(np.concatenate([rain, snow])).max(), 0.1) * 1.05)
+
+    ax_clouds.set_prop_cycle(None)
+    artists += ax_clouds.plot(x, dset_city['CLCT'].transpose('step', 'number').values, 'o',
+                              zorder=1, markersize=5)
+    artists += ax_clouds.plot(x, dset_city['CLCT'].mean(dim='number'), '-',
+                              linewidth=2, zorder=2, color='black')
+    artists.append(ax_clouds.annotate('Grid point %3.1fN %3.1fE' % (dset_city.clat, dset_city.clon),
+                                      xy=(0.7, -0.4), xycoords='axes fraction', color="gray"))
+
+    for ax in [ax_temp, ax_clouds]:
+        ax.relim()
+        ax.autoscale_view()
+    ax_clouds.set_ylim(bottom=0)
+    for ax in [ax_temp, ax_prec, ax_clouds]:
+        ax.set_xlim(x[0], x[-1])
+
+    fig.savefig(folder_images+"meteogram_"+city, dpi=100, bbox_inches='tight')
+
+    for artist in artists:
+        artist.remove()
 
 
 if __name__ == "__main__":
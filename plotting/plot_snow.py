@@ -1,7 +1,6 @@
 import matplotlib.pyplot as plt
 import numpy as np
-from multiprocessing import Pool
-from functools import partial
+import xarray as xr
 import utils
 import sys
 
@@ -13,32 +12,29 @@ if not debug:
 
 # The one employed for the figure name when exported
 variable_name = 'prob_snow'
+# Variables to be read with utils.LazyDataset
+variables = ['snow_gsp', 'snow_con', 'tot_prec']
+# Rates need the previous step, see run_stream.py
+needs_previous = True
 
-utils.print_message('Starting script to plot '+variable_name)
-
-# Get the projection as system argument from the call so that we can
-# span multiple instances of this script outside
-if not sys.argv[1:]:
-    utils.print_message(
-        'Projection not defined, falling back to default (euratl)')
-    projection = 'euratl'
-else:
-    projection = sys.argv[1]
-
-
-def main():
-    dset = utils.read_dataset(
-        ['snow_gsp', 'snow_con', 'tot_prec'], region=projection)
 
+def compute(dset):
+    """Probability of snow rate > 0.25 mm/h and rain rate > 0.1 mm/h"""
     snow_acc = dset['csrwe'] + dset['lssrwe']
-    snow = snow_acc.differentiate(coord="step", datetime_unit="h")
-    rain = dset['tp'].differentiate(coord="step", datetime_unit="h")
+    snow = utils.accumulated_to_rate(snow_acc)
+    rain = utils.accumulated_to_rate(dset['tp'])
+
+    snow_prob = utils.compute_probabilities(
+        snow, [0.25])['prob'].sel(threshold=0.25, drop=True).rename('snow_prob')
+    prec_prob = utils.compute_probabilities(
+        rain, [0.1])['prob'].sel(threshold=0.1, drop=True).rename('prec_prob')
+    # Snow has fewer steps than tot_prec in the 06/18 runs, keep all of them
+    return xr.merge([snow_prob, prec_prob], join='outer')
 
-    dset['snow_prob'] = ((snow > 0.25).sum(
-        dim='number') / len(dset.number)) * 100
-    dset['prec_prob'] = ((rain > 0.1).sum(
-        dim='number') / len(dset.number)) * 100
 
+def setup(dset, projection):
+    """Create the figure with the static part of the frames on projection,
+    returns the arguments of plot_files"""
     levels = np.linspace(10, 100, 10)
 
     cmap_snow, norm_snow = utils.get_colormap_norm("snow", levels)
@@ -48,51 +44,61 @@ def main():
 
     ax = plt.gca()
     m, x, y = utils.get_projection(dset, projection, labels=True)
+    triang = utils.get_triangulation(x, y, projection)
     m.fillcontinents(color='lightgray', lake_color='whitesmoke', zorder=0)
 
-    dset = dset.drop(['csrwe', 'lssrwe', 'tp', 'clon', 'clat']).load()
-
     # All the arguments that need to be passed to the plotting function
-    args = dict(x=x, y=y, ax=ax, cmap_snow=cmap_snow, norm_snow=norm_snow,
-                cmap_rain=cmap_rain, norm_rain=norm_rain, levels=levels)
+    return dict(triang=triang, ax=ax, cmap_snow=cmap_snow, norm_snow=norm_snow,
+                cmap_rain=cmap_rain, norm_rain=norm_rain, levels=levels,
+                projection=projection)
+
+
+def plot(dset, projection, scheduler):
+    """Submit the frames on projection to scheduler. The figure is only
+    created the first time for every projection"""
+    ds = dset.drop_vars(['clon', 'clat'], errors='ignore')
 
-    utils.print_message('Pre-processing finished, launching plotting scripts')
     if debug:
-        plot_files(dset.isel(step=slice(0, 2)), **args)
+        plot_files(ds.isel(step=slice(0, 2)), **setup(dset, projection))
     else:
-        # Parallelize the plotting by dividing into chunks and processes
-        dss = utils.chunks_dataset(dset, utils.chunks_size)
-        plot_files_param = partial(plot_files, **args)
-        p = Pool(utils.processes)
-        p.map(plot_files_param, dss)
+        # Every step is rendered as a separate frame by the pool of workers
+        scheduler.submit(plot_files, ds, key=(variable_name, projection),
+                         setup=lambda: setup(dset, projection))
+
+
+def main(projection):
+    # Only the variables used by compute are opened
+    dset = utils.LazyDataset(variables, region=projection)
+    with utils.FrameScheduler() as scheduler:
+        plot(compute(dset), projection, scheduler)
 
 
 def plot_files(dss, **args):
-    first = True
+    renderer = utils.get_renderer(args['ax'].figure)
+    first = renderer.first
     for time_sel in dss.step:
         data = dss.sel(step=time_sel)
         time, run, cum_hour = utils.get_time_run_cum(data)
         # Build the name of the output image
-        filename = utils.subfolder_images[projection] + \
+        filename = utils.subfolder_images[args['projection']] + \
             '/' + variable_name + '_%s.png' % cum_hour
 
-        cs = args['ax'].tricontourf(args['x'],
-                                    args['y'],
-                                    data['prec_prob'],
-                                    extend='max',
-                                    cmap=args['cmap_rain'],
-                                    norm=args['norm_rain'],
-                                    levels=args['levels'],
-                                    zorder=1)
-
-        css = args['ax'].tricontourf(args['x'],
-                                     args['y'],
-                                     data['snow_prob'],
-                                     extend='max',
-                                     cmap=args['cmap_snow'],
-                                     norm=args['norm_snow'],
-                                     levels=args['levels'],
-                                     zorder=2)
+        cs = utils.contourf(args['ax'], args['triang'],
+                            data['prec_prob'],
+                            extend='max',
+                            cmap=args['cmap_rain'],
+                            norm=args['norm_rain'],
+                            levels=args['levels'],
+                            zorder=1)
+
+        # Missing after the last step of snow (see compute), nothing to draw
+        css = utils.contourf(args['ax'], args['triang'],
+                             data['snow_prob'].fillna(0),
+                             extend='max',
+                             cmap=args['cmap_snow'],
+                             norm=args['norm_snow'],
+                             levels=args['levels'],
+                             zorder=2)
 
         an_fc = utils.annotation_forecast(args['ax'], time)
         an_var = utils.annotation(
@@ -101,25 +107,36 @@ def plot_files(dss, **args):
 
         if first:
             ax_cbar, ax_cbar_2 = utils.divide_axis_for_cbar(args['ax'])
-            cbar_snow = plt.gcf().colorbar(css, cax=ax_cbar, orientation='horizontal',
-                                           label='Snow [cm/hr]')
-            cbar_rain = plt.gcf().colorbar(cs, cax=ax_cbar_2, orientation='horizontal',
-                                           label='Rain [mm/hr]')
+            cbar_snow = args['ax'].figure.colorbar(css, cax=ax_cbar, orientation='horizontal',
+                                                   label='Snow [cm/hr]')
+            cbar_rain = args['ax'].figure.colorbar(cs, cax=ax_cbar_2, orientation='horizontal',
+                                                   label='Rain [mm/hr]')
 
         if debug:
             plt.show(block=True)
         else:
-            plt.savefig(filename, **utils.options_savefig)
+            renderer.save(filename, [cs, css, an_fc, an_var, an_run])
 
-        utils.remove_collections([cs, an_fc, an_var, an_run])
+        utils.remove_collections([cs, css, an_fc, an_var, an_run])
 
         first = False
 
 
 if __name__ == "__main__":
     import time
+    utils.print_message('Starting script to plot '+variable_name)
+
+    # Get the projection as system argument from the call so that we can
+    # span multiple instances of this script outside
+    if not sys.argv[1:]:
+        utils.print_message(
+            'Projection not defined, falling back to default (euratl)')
+        projection = 'euratl'
+    else:
+        projection = sys.argv[1]
+
     start_time = time.time()
-    main()
+    main(projection)
     elapsed_time = time.time()-start_time
     utils.print_message(
         "script took " + time.strftime("%H:%M:%S", time.gmtime(elapsed_time)))
@@ -1,7 +1,5 @@
 import matplotlib.pyplot as plt
 import numpy as np
-from multiprocessing import Pool
-from functools import partial
 import utils
 import sys
 
@@ -13,67 +11,72 @@ if not debug:
 
 # The one employed for the figure name when exported
 variable_name = 'prob_prec'
+# Variables to be read with utils.LazyDataset
+variables = ['tot_prec']
 
-utils.print_message('Starting script to plot '+variable_name)
+thresholds = [50, 100]
 
-# Get the projection as system argument from the call so that we can
-# span multiple instances of this script outside
-if not sys.argv[1:]:
-    utils.print_message(
-        'Projection not defined, falling back to default (euratl)')
-    projection = 'euratl'
-else:
-    projection = sys.argv[1]
 
-thresholds = [50, 100]
+def compute(dset):
+    """Probability of total precipitation exceeding every threshold"""
+    return utils.compute_probabilities(dset['tp'], thresholds)[['prob']]
 
 
-def main():
-    dset = utils.read_dataset(['tot_prec'], region=projection)
+def setup(dset, projection):
+    """Create the figure with the static part of the frames on projection,
+    returns the arguments of plot_files"""
+    _ = plt.figure(figsize=(utils.figsize_x, utils.figsize_y))
 
-    for threshold in thresholds:
-        ds = ((dset['tp'] > threshold).sum(dim='number') / len(dset.number))*100
-        ds.attrs['threshold'] = threshold
-        ds = ds.load()
+    ax = plt.gca()
+    m, x, y = utils.get_projection(dset, projection, labels=True)
+    triang = utils.get_triangulation(x, y, projection)
+    m.fillcontinents(color='lightgray', lake_color='whitesmoke', zorder=0)
 
-        _ = plt.figure(figsize=(utils.figsize_x, utils.figsize_y))
+    # All the arguments that need to be passed to the plotting function
+    return dict(triang=triang, ax=ax, projection=projection)
 
-        ax = plt.gca()
-        m, x, y = utils.get_projection(dset, projection, labels=True)
-        m.fillcontinents(color='lightgray', lake_color='whitesmoke', zorder=0)
 
-        # All the arguments that need to be passed to the plotting function
-        args = dict(x=x, y=y, ax=ax)
+def plot(dset, projection, scheduler):
+    """Submit the frames of every threshold on projection to scheduler. The
+    figures are only created the first time for every projection"""
+    for threshold in thresholds:
+        ds = dset['prob'].sel(threshold=threshold, drop=True)
+        ds.attrs['threshold'] = threshold
+        ds = ds.drop_vars(['clon', 'clat'], errors='ignore')
 
-        utils.print_message(
-            'Pre-processing finished, launching plotting scripts')
         if debug:
-            plot_files(ds.isel(step=slice(0, 2)), **args)
+            plot_files(ds.isel(step=slice(0, 2)), **setup(dset, projection))
         else:
-            # Parallelize the plotting by dividing into chunks and processes
-            dss = utils.chunks_dataset(ds, utils.chunks_size)
-            plot_files_param = partial(plot_files, **args)
-            p = Pool(utils.processes)
-            p.map(plot_files_param, dss)
+            # Every step is rendered as a separate frame by the pool of workers
+            scheduler.submit(plot_files, ds, key=(variable_name, projection, threshold),
+                             setup=lambda: setup(dset, projection))
+
+
+def main(projection):
+    # Only the variables used by compute are opened
+    dset = utils.LazyDataset(variables, region=projection)
+    with utils.FrameScheduler() as scheduler:
+        plot(compute(dset), projection, scheduler)
 
 
 def plot_files(dss, **args):
-    first = True
+    renderer = utils.get_renderer(args['ax'].figure)
+    first = renderer.first
     for time_sel in dss.step:
         data = dss.sel(step=time_sel)
         time, run, cum_hour = utils.get_time_run_cum(data)
         # Build the name of the output image
-        filename = utils.subfolder_images[projection] + '/' + \
+        filename = utils.subfolder_images[args['projection']] + '/' + \
             variable_name + '_%s_%s.png' % (data.attrs['threshold'], cum_hour)
 
         cmap = plt.get_cmap('gist_stern_r')
         new_cmap = utils.truncate_colormap(cmap, 0, 0.9)
 
-        cs = args['ax'].tricontourf(args['x'], args['y'],
-                                    data.values,
-                                    extend='max',
-                                    cmap=new_cmap,
-                                    levels=np.linspace(10, 100, 10))
+        cs = utils.contourf(args['ax'], args['triang'],
+                            data.values,
+                            extend='max',
+                            cmap=new_cmap,
+                            levels=np.linspace(10, 100, 10))
 
         an_fc = utils.annotation_forecast(args['ax'], time)
         an_var = utils.annotation(args['ax'], 'Prob. total precipitation exceeding %s mm' %
@@ -81,12 +84,12 @@ def plot_files(dss, **args):
         an_run = utils.annotation_run(args['ax'], run)
 
         if first:
-            plt.colorbar(cs, orientation='horizontal', label='Probability [%]',
-                         fraction=0.04, pad=0.04)
+            args['ax'].figure.colorbar(cs, ax=args['ax'], orientation='horizontal',
+                                       label='Probability [%]', fraction=0.04, pad=0.04)
         if debug:
             plt.show(block=True)
         else:
-            plt.savefig(filename, **utils.options_savefig)
+            renderer.save(filename, [cs, an_fc, an_var, an_run])
 
         utils.remove_collections([cs, an_fc, an_var, an_run])
 
@@ -95,8 +98,19 @@ def plot_files(dss, **args):
 
 if __name__ == "__main__":
     import time
+    utils.print_message('Starting script to plot '+variable_name)
+
+    # Get the projection as system argument from the call so that we can
+    # span multiple instances of this script outside
+    if not sys.argv[1:]:
+        utils.print_message(
+            'Projection not defined, falling back to default (euratl)')
+        projection = 'euratl'
+    else:
+        projection = sys.argv[1]
+
     start_time = time.time()
-    main()
+    main(projection)
     elapsed_time = time.time()-start_time
     utils.print_message(
         "script took " + time.strftime("%H:%M:%S", time.gmtime(elapsed_time)))
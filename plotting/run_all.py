@@ -0,0 +1,61 @@
+import matplotlib.pyplot as plt
+import utils
+import sys
+import plot_max_gust
+import plot_tot_prec
+import plot_snow
+import plot_clouds
+import plot_tmax
+
+# Single driver for all the map products: the ensemble is opened once, the
+# probabilities of every product are computed once on the whole domain and
+# then the frames of all products and projections are rendered by the same
+# pool of workers. The plot_*.py modules only define the products and can
+# still be run standalone for a single projection.
+
+products = [plot_max_gust, plot_tot_prec, plot_snow, plot_clouds, plot_tmax]
+
+# Figures are closed once submitted but workers keep one for every product
+plt.rcParams['figure.max_open_warning'] = 0
+
+
+def main(projections, images=True, export=False, regrid=False):
+    variables = []
+    for product in products:
+        variables += [v for v in product.variables if v not in variables]
+    # Every variable is opened once, when the first product needs it
+    dset = utils.LazyDataset(variables)
+
+    with utils.FrameScheduler() as scheduler:
+        for product in products:
+            utils.print_message('Computing ' + product.variable_name)
+            fields = product.compute(dset)
+            for projection in projections:
+                fields_projection = fields.isel(cell=utils.get_region_index(projection))
+                if export:
+                    utils.export_fields(fields_projection, product.variable_name, projection)
+                if images:
+                    if regrid:
+                        # Much cheaper contourf on a regular grid instead of tricontourf
+                        fields_projection = utils.regrid(fields_projection, projection)
+                    product.plot(fields_projection, projection, scheduler)
+
+
+if __name__ == "__main__":
+    import time
+    utils.print_message('Starting driver to plot all products')
+
+    # --no-images skips the plotting, --fields exports the raw probabilities
+    # (see utils.export_fields) for the web page to draw them, --regrid plots
+    # the fields remapped onto a regular grid (see utils.regrid)
+    options = [arg for arg in sys.argv[1:] if arg.startswith('--')]
+    projections = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if not projections:
+        projections = ['euratl', 'it', 'de']
+
+    start_time = time.time()
+    main(projections, images='--no-images' not in options, export='--fields' in options,
+         regrid='--regrid' in options)
+    elapsed_time = time.time()-start_time
+    utils.print_message(
+        "script took " + time.strftime("%H:%M:%S", time.gmtime(elapsed_time)))
@@ -0,0 +1,137 @@
+import utils
+import sys
+import os
+import time
+from run_all import products
+sys.path.append(utils.home_folder)
+from get_last_run import get_listings, f_times
+from download_dwd import Downloader, print_stats
+
+# Streaming driver: instead of waiting for the whole run to be on the DWD
+# server, every step is downloaded, decoded, reduced to probabilities and
+# rendered as soon as all the variables of a product are available for it.
+# The early lead times are then published while the rest of the run is
+# still being uploaded.
+
+base_url = "https://opendata.dwd.de/weather/nwp/icon-eu-eps/grib"
+file_prefix = "icon-eu-eps_europe_icosahedral_single-level"
+# Seconds between two polls of the server
+poll_interval = 60
+# Give up if no new step shows up for this long
+idle_timeout = 3600
+# Some variables (e.g. snow_gsp in the 06/18 runs) are not uploaded for all
+# steps: once the other products are complete, stop after this long if the
+# next steps of the remaining ones are past the last step on the server
+grace_period = 600
+
+
+def step_url(var, date_string, run_string, step):
+    return "%s/%s/%s/%s_%s%s_%03d_%s.grib2.bz2" % (base_url, run_string, var, file_prefix,
+                                                  date_string, run_string, step, var)
+
+
+def step_file(url):
+    return os.path.join(utils.folder, os.path.basename(url).replace('.bz2', ''))
+
+
+def last_step_on_server(product, on_server, date_string, run_string):
+    """Last step for which all the variables of product are on the server, -1 if none"""
+    steps = [step for step in f_times
+             if all(step_url(var, date_string, run_string, step) in on_server
+                    for var in product.variables)]
+    return max(steps, default=-1)
+
+
+def main(run, projections, images=True, export=False, regrid=False):
+    date_string, run_string = run[0:8], run[8:10]
+    variables = []
+    for product in products:
+        variables += [v for v in product.variables if v not in variables]
+    # Next step to be processed for every product, in order as rates need the previous one
+    pending = {product: list(f_times) for product in products}
+    previous = {product: None for product in products}
+    downloader = Downloader(output_folder=utils.folder)
+    last_update = time.time()
+    stalled_since = None
+
+    with utils.FrameScheduler() as scheduler:
+        while any(pending.values()) and time.time() - last_update < idle_timeout:
+            listings = get_listings(["%s/%s/%s/" % (base_url, run_string, var) for var in variables],
+                                    'grib2.bz2', prefix=file_prefix)
+            on_server = set(url for urls in listings.values() for url in urls)
+            processed = False
+            for product in products:
+                while pending[product]:
+                    step = pending[product][0]
+                    urls = [step_url(var, date_string, run_string, step) for var in product.variables]
+                    if not set(urls).issubset(on_server):
+                        break
+                    stats = downloader.download(urls)
+                    print_stats(stats)
+                    if any(s['status'] == 'failed' for s in stats):
+                        break
+
+                    files = {var: [step_file(url)] for var, url in zip(product.variables, urls)}
+                    needs_previous = getattr(product, 'needs_previous', False)
+                    # Rates are computed from the previous step, only read it when needed
+                    if needs_previous and previous[product] is not None:
+                        for var in product.variables:
+                            files[var].insert(0, step_file(step_url(var, date_string, run_string,
+                                                                    previous[product])))
+                    if previous[product] is not None or not needs_previous:
+                        dset = utils.LazyDataset(product.variables, files=files)
+                        fields = product.compute(dset).isel(step=[-1])
+                        for projection in projections:
+                            fields_projection = fields.isel(cell=utils.get_region_index(projection))
+                            if export:
+                                utils.export_fields(fields_projection, product.variable_name,
+                                                    projection)
+                            if images:
+                                if regrid:
+                                    fields_projection = utils.regrid(fields_projection, projection)
+                                product.plot(fields_projection, projection, scheduler)
+                        utils.print_message('Submitted step %d of %s' % (step, product.variable_name))
+
+                    previous[product] = step
+                    pending[product].pop(0)
+                    processed = True
+
+            # Products still waiting for steps that are not (and may never be) on the server
+            stalled = [product for product in products if pending[product] and
+                       pending[product][0] > last_step_on_server(product, on_server,
+                                                                 date_string, run_string)]
+            if stalled and len(stalled) < len(products) and \
+                    all(product in stalled for product in products if pending[product]):
+                if stalled_since is None:
+                    stalled_since = time.time()
+                elif time.time() - stalled_since > grace_period:
+                    utils.print_message('No more steps of %s on the server, stopping' %
+                                        ', '.join(product.variable_name for product in stalled))
+                    break
+            else:
+                stalled_since = None
+
+            if processed:
+                last_update = time.time()
+            else:
+                time.sleep(poll_interval)
+
+
+if __name__ == "__main__":
+    utils.print_message('Starting streaming driver to plot all products')
+
+    # The run (YYYYMMDDHH) needs to be defined, projections are optional.
+    # Same options as run_all.py: --no-images, --fields and --regrid
+    options = [arg for arg in sys.argv[1:] if arg.startswith('--')]
+    arguments = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    run = arguments[0]
+    projections = arguments[1:]
+    if not projections:
+        projections = ['euratl', 'it', 'de']
+
+    start_time = time.time()
+    main(run, projections, images='--no-images' not in options, export='--fields' in options,
+         regrid='--regrid' in options)
+    elapsed_time = time.time()-start_time
+    utils.print_message(
+        "script took " + time.strftime("%H:%M:%S", time.gmtime(elapsed_time)))
@@ -14,8 +14,16 @@ from matplotlib.offsetbox import AnnotationBbox, OffsetImage
 import metpy
 import re
 from matplotlib.image import imread as read_png
+from matplotlib.artist import Artist
 import requests
 import json
+import hashlib
+import pickle
+import tempfile
+import shutil
+import threading
+from contextlib import contextmanager
+from multiprocessing import Pool
 from mpl_toolkits.axes_grid1.inset_locator import inset_axes
 
 import warnings
@@ -24,7 +32,8 @@ warnings.filterwarnings(
     message='The unit of the quantity is stripped.'
 )
 
-apiKey = os.environ['MAPBOX_KEY']
+# Only needed to geocode the cities not in cities_file yet
+apiKey = os.environ.get('MAPBOX_KEY')
 apiURL_places = "https://api.mapbox.com/geocoding/v5/mapbox.places"
 
 if 'MODEL_DATA_FOLDER' in os.environ:
@@ -33,11 +42,41 @@ else:
     folder = '/home/ekman/ssd/guido/icon-eu-eps/'
 
 folder_images = folder
-chunks_size = 10
-processes = 2
+# The CPUs available to us are shared by the processes plotting the frames
+# and the ones compressing them (see FrameScheduler), which work at the same time
+cpus = len(os.sched_getaffinity(0))
+# Number of processes compressing the frames while the others keep plotting
+if 'ENCODE_PROCESSES' in os.environ:
+    encode_processes = int(os.environ['ENCODE_PROCESSES'])
+else:
+    encode_processes = max(1, cpus // 4)
+# Number of plotting processes, by default the CPUs left to us by the encoders
+if 'PLOT_PROCESSES' in os.environ:
+    processes = int(os.environ['PLOT_PROCESSES'])
+else:
+    processes = max(1, cpus - encode_processes)
 figsize_x = 11
 figsize_y = 9
 invariant_file = folder+'invariant_*.nc'
+# Chunked and compressed store written once per run by convert_grib.py,
+# one group for every downloaded variable
+store_file = folder+'icon_eu_eps.zarr'
+grid_file = folder+'icon_grid_0037_R03B07_N02.nc'
+# Time series of the cities nearest cells, written by extract_points.py
+# with one group for every city
+points_file = folder+'icon_eu_eps_points.zarr'
+# Variables of the time series, the ones read by plot_meteogram.py
+point_variables = ['t_2m', 'tot_prec', 'snow_gsp', 'snow_con', 'clct']
+# cfgrib indices of the downloaded GRIB files, named after their content
+index_folder = folder+'grib_index/'
+# Dask chunks used to open the variables, selected by name in read_dataset
+chunk_profiles = {
+    # Probabilities and ensemble statistics reduce over the members, so keep
+    # all of them in the same chunk and split over steps and cells instead
+    'members': {'number': -1, 'step': 1, 'values': 'auto'},
+    # Time series in a few cells need all steps together
+    'points': {'number': -1, 'step': -1, 'values': 'auto'},
+}
 
 if "HOME_FOLDER" in os.environ:
     home_folder = os.environ['HOME_FOLDER']
@@ -51,6 +90,15 @@ options_savefig = {
     'transparent': False
 }
 
+# Draw the static background of the maps only once and blit every frame
+# on top of it (see FrameRenderer). Set to False to go back to savefig.
+blit_frames = True
+# Format of the frames written by encode_frame ('png' or 'webp'). One frame
+# every frame_compare_every is also encoded as full colour PNG, only to
+# estimate the bytes saved (0 to never do it, as it costs a second encoding)
+frame_format = 'png'
+frame_compare_every = 50
+
 # Dictionary to map the output folder based on the projection employed
 subfolder_images = {
     'euratl' : folder_images,
@@ -58,6 +106,9 @@ subfolder_images = {
     'de' : folder_images+'de'
 }
 
+# Raw probability fields for client side rendering, see export_fields
+fields_folder = folder_images + 'fields/'
+
 folder_glyph = home_folder + '/plotting/yrno_png/'
 WMO_GLYPH_LOOKUP_PNG = {
         '0': '01',
@@ -141,29 +192,366 @@ proj_defs = {
 }
 
 
+@contextmanager
+def atomic_write(path, mode='w'):
+    """Open a temporary file next to path, moved in its place only once
+    written without errors. Many processes read (or upload, see
+    upload_ftp.py) these files while others are writing them, so they must
+    never see a partial one. The temporary file is hidden so that it
+    doesn't match the patterns of the files. With mode None its name is
+    returned instead, for writers that only take a file name."""
+    tmp_file = os.path.join(os.path.dirname(path), '.%s.%d.%d.tmp' % (
+        os.path.basename(path), os.getpid(), threading.get_ident()))
+    try:
+        if mode is None:
+            yield tmp_file
+        else:
+            with open(tmp_file, mode) as f:
+                yield f
+        os.replace(tmp_file, path)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def get_grib_index(file):
+    """Return the path of the cfgrib index of file in index_folder. This is
+    named after a digest of the file size and of its first and last blocks,
+    which already contain the date, step and variable of the messages."""
+    h = hashlib.sha1()
+    size = os.path.getsize(file)
+    h.update(str(size).encode())
+    with open(file, 'rb') as f:
+        h.update(f.read(1 << 16))
+        f.seek(max(0, size - (1 << 16)))
+        h.update(f.read())
+    return f"{index_folder}{h.hexdigest()}.idx"
+
+
+def build_grib_index(file):
+    """Build the cfgrib index of file in index_folder if it's not there yet
+    (or older than file, which may have been downloaded again with the same
+    size and ends), returns its path. Should be called once right after the
+    download, after which all processes reading file share the index read-only."""
+    file = os.path.abspath(file)
+    index_file = get_grib_index(file)
+    if os.path.isfile(index_file) and \
+            os.path.getmtime(index_file) >= os.path.getmtime(file):
+        return index_file
+
+    os.makedirs(index_folder, exist_ok=True)
+    # cfgrib writes the index itself, so let it write a temporary one and
+    # move it in place only once complete
+    with atomic_write(index_file, None) as tmp_file:
+        xr.open_dataset(file, engine='cfgrib',
+                        backend_kwargs={'errors': 'ignore', 'indexpath': tmp_file}).close()
+
+    return index_file
+
+
+def get_chunks(chunks):
+    """Return the chunks of the profile named chunks in chunk_profiles,
+    or chunks itself if this is already a dict"""
+    if isinstance(chunks, str):
+        return chunk_profiles[chunks]
+    return chunks
+
+
+def read_grib(var, files=None, chunks='members'):
+    """Decode the GRIB files of a single variable, one file per step as
+    downloaded from the server (by default all the ones found in folder).
+    The files are concatenated along step directly, each one with its
+    own cfgrib index, so no merged copy is ever written. Every field is
+    decoded whole, so only the number dimension of chunks is used."""
+    chunks = get_chunks(chunks)
+    if files is None:
+        files = sorted(glob(f"{folder}/*_{var}.grib2"))
+    if not files:
+        raise OSError('no files to open for %s' % var)
+    dss = []
+    for file in files:
+        # Indices are bound to the path of the file, so always use the same one
+        file = os.path.abspath(file)
+        dss.append(xr.open_dataset(file, engine='cfgrib',
+                                   chunks={'number': chunks.get('number', 1)},
+                                   backend_kwargs={'errors': 'ignore',
+                                                   'indexpath': build_grib_index(file)}))
+    dset = xr.combine_nested(dss,
+                             concat_dim='step',
+                             # Only the fields and valid_time change between steps
+                             data_vars='all',
+                             coords=['valid_time'],
+                             compat='override')
+    # step is added in front, keep the layout of the merged files instead
+    return dset.transpose('number', 'step', ..., missing_dims='ignore')
+
+
+def store_encoding(names):
+    """Encoding of the variables names written in a zarr store, compressed
+    with zstd as this is both small and fast to decompress"""
+    from zarr.codecs import BloscCodec
+    compressor = BloscCodec(cname='zstd', clevel=3, shuffle='bitshuffle')
+    return {name: {'compressors': [compressor]} for name in names}
+
+
+def in_store(var):
+    """Whether var was converted into store_file. A conversion that failed
+    may leave the group of var behind, without any array in it."""
+    if not os.path.isdir(f"{store_file}/{var}"):
+        return False
+    import zarr
+    try:
+        group = zarr.open_group(store_file, path=var, mode='r')
+    except (FileNotFoundError, ValueError, KeyError):
+        return False
+    return any(True for _ in group.array_keys())
+
+
+def open_variable(var, files=None, chunks='members'):
+    """Open a single variable lazily from the converted store, falling back
+    to the GRIB files if the conversion stage was not run (or failed). If files
+    is given only these GRIB files are read. chunks is either a dict or
+    the name of one of chunk_profiles."""
+    if files is None and in_store(var):
+        return xr.open_zarr(store_file, group=var, chunks=get_chunks(chunks))
+    return read_grib(var, files, chunks)
+
+
+class LazyDataset():
+    """Dict-like access to the fields of the variables in vars (DWD names).
+    Every variable is opened (see open_variable) only when one of its fields
+    is first requested, with the grid coordinates from get_grid_coordinates
+    attached and subset to region if given. files can map every variable
+    to the list of GRIB files to be read, see run_stream.py, and chunks
+    is passed to open_variable."""
+
+    def __init__(self, vars, region=None, files=None, chunks='members'):
+        self.vars = list(vars)
+        self.region = region
+        self.files = files
+        self.chunks = chunks
+        self._opened = {}
+
+    def _open(self, var):
+        if var not in self._opened:
+            ds = open_variable(var, None if self.files is None else self.files[var],
+                               self.chunks)
+            ds = ds.rename({'values': 'cell'})
+            clon, clat = get_grid_coordinates()
+            # Keep the coordinates attached to every variable derived from ds
+            ds = ds.assign_coords(clon=('cell', clon, {'units': 'degrees_east'}),
+                                  clat=('cell', clat, {'units': 'degrees_north'}))
+            if self.region:
+                ds = ds.isel(cell=get_region_index(self.region))
+            self._opened[var] = ds
+        return self._opened[var]
+
+    def __getitem__(self, name):
+        # Open the variables in order only until one contains name
+        for var in self.vars:
+            ds = self._open(var)
+            if name in ds.variables:
+                return ds[name]
+        raise KeyError(name)
+
+    def to_dataset(self):
+        """Open all variables and merge them in a single Dataset"""
+        return xr.merge([self._open(var) for var in self.vars], compat='override')
+
+
 def read_dataset(vars=['tmax_2m', 'vmax_10m'],
-                 region=None):
-    """Wrapper to initialize the dataset"""
+                 region=None, files=None, chunks='members'):
+    """Wrapper to initialize the dataset with all vars at once, see LazyDataset"""
+    return LazyDataset(vars, region=region, files=files, chunks=chunks).to_dataset()
+
+
+def extract_points(cities, vars=point_variables):
+    """Extract the time series of all members of vars in the grid cells
+    nearest to cities with a single pass over the full domain.
+    Returns one Dataset for every city."""
+    dset = read_dataset(vars, chunks='points')
+    lons, lats = zip(*get_cities_coordinates(cities))
+    points = dset.isel(cell=find_nearest_cells(lons, lats)).compute()
+
+    return [points.isel(cell=i).assign_attrs(city=city) for i, city in enumerate(cities)]
+
+
+def read_points(cities, vars=point_variables):
+    """Return one Dataset for every city, read from the points store when
+    available and extracted from the full domain otherwise."""
+    missing = [city for city in cities if not os.path.isdir(f"{points_file}/{city}")]
+    if missing:
+        extracted = dict(zip(missing, extract_points(missing, vars)))
+
     dss = []
-    for var in vars:
-        dss.append(xr.open_mfdataset(f"{folder}/*{var}*.grib2",
-                                     chunks={'number': 1},
-                                     backend_kwargs={'errors': 'ignore'}))
-    dset = xr.merge(dss, compat='override')
-    dset = dset.rename({'values':'cell'})
-    grid = xr.open_dataset(f"{folder}/icon_grid_0037_R03B07_N02.nc")
-    dset = xr.merge([dset, grid[['clon','clat']]])
-    dset['clon'] = dset['clon'].metpy.convert_units('degrees').metpy.dequantify()
-    dset['clat'] = dset['clat'].metpy.convert_units('degrees').metpy.dequantify()
-
-    if region:
-        proj = proj_defs[region]
-        min_lon, max_lon = proj['llcrnrlon'], proj['urcrnrlon']
-        min_lat, max_lat = proj['llcrnrlat'], proj['urcrnrlat']
-        dset = dset.where((dset.clon >= min_lon) & (dset.clat >= min_lat) & (
-            dset.clat <= max_lat) & (dset.clon <= max_lon), drop=True)
-
-    return dset
+    for city in cities:
+        if city in missing:
+            dss.append(extracted[city])
+        else:
+            dss.append(xr.open_zarr(points_file, group=city).load().assign_attrs(city=city))
+
+    return dss
+
+
+def get_grid_coordinates():
+    """Return the longitude and latitude (in degrees) of the centers of all
+    the grid cells. These are read from the grid file only once and then
+    cached on disk next to it."""
+    cache_file = f"{folder}/grid_coordinates.npz"
+    if os.path.isfile(cache_file) and \
+            os.path.getmtime(cache_file) >= os.path.getmtime(grid_file):
+        with np.load(cache_file) as f:
+            return f['clon'], f['clat']
+
+    grid = xr.open_dataset(grid_file)
+    clon = np.rad2deg(grid['clon'].values)
+    clat = np.rad2deg(grid['clat'].values)
+    with atomic_write(cache_file, 'wb') as f:
+        np.savez(f, clon=clon, clat=clat)
+
+    return clon, clat
+
+
+def get_region_index(region):
+    """Return the integer index of the grid cells falling inside the
+    bounds of region in proj_defs. This is computed from the grid file
+    only once and then cached on disk next to it."""
+    cache_file = f"{folder}/region_index_{region}.npy"
+    if os.path.isfile(cache_file) and \
+            os.path.getmtime(cache_file) >= os.path.getmtime(grid_file):
+        return np.load(cache_file)
+
+    clon, clat = get_grid_coordinates()
+    proj = proj_defs[region]
+    idx = np.flatnonzero((clon >= proj['llcrnrlon']) & (clat >= proj['llcrnrlat']) &
+                         (clat <= proj['urcrnrlat']) & (clon <= proj['urcrnrlon']))
+    # Write to a temporary file first as many scripts can get here at the same time
+    with atomic_write(cache_file, 'wb') as f:
+        np.save(f, idx)
+
+    return idx
+
+
+def compute_probabilities(da, thresholds, percentiles=None, mean=False,
+                          dim='number'):
+    """Compute the probability (in %) of da exceeding every threshold, and
+    optionally the ensemble percentiles and mean, in a single computation
+    so that every chunk of da is loaded only once. This is done chunk by
+    chunk, so dim should not be split over chunks (see chunk_profiles).
+    Returns a Dataset with 'prob' along a new 'threshold' dimension and,
+    if requested, 'percentiles' (along 'percentile') and 'mean'."""
+    thresholds = np.atleast_1d(thresholds)
+    thr = xr.DataArray(thresholds, dims='threshold', coords={'threshold': thresholds})
+
+    out = xr.Dataset()
+    out['prob'] = ((da > thr).mean(dim) * 100).transpose('threshold', ...)
+    if mean:
+        out['mean'] = da.mean(dim)
+    if percentiles is not None:
+        percentiles = np.atleast_1d(percentiles)
+        # Not named as its dimension, otherwise it would become a coordinate
+        out['percentiles'] = da.quantile(percentiles / 100, dim=dim, skipna=True)\
+            .rename(quantile='percentile').assign_coords(percentile=percentiles)
+
+    return out.compute()
+
+
+def lonlat_to_xyz(lon, lat):
+    """Convert lon/lat in degrees to unit vectors on the sphere, so that
+    euclidean nearest neighbours are also the closest on the sphere."""
+    lon, lat = np.deg2rad(lon), np.deg2rad(lat)
+    return np.column_stack([np.cos(lat) * np.cos(lon),
+                            np.cos(lat) * np.sin(lon),
+                            np.sin(lat)])
+
+
+def get_grid_tree():
+    """Return a KD-tree of the grid cell centres (as unit vectors on the sphere).
+    This is built from the grid file only once and then pickled on disk."""
+    from scipy.spatial import cKDTree
+    cache_file = f"{folder}/grid_tree.pickle"
+    if os.path.isfile(cache_file) and \
+            os.path.getmtime(cache_file) >= os.path.getmtime(grid_file):
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
+
+    tree = cKDTree(lonlat_to_xyz(*get_grid_coordinates()))
+    with atomic_write(cache_file, 'wb') as f:
+        pickle.dump(tree, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    return tree
+
+
+def find_nearest_cells(lons, lats):
+    """Return the index of the grid cell closest to every lon/lat point
+    (in degrees), all resolved with a single query of the KD-tree."""
+    _, idx = get_grid_tree().query(lonlat_to_xyz(np.atleast_1d(lons),
+                                                 np.atleast_1d(lats)))
+    return idx
+
+
+def get_regrid_grid(region, resolution=0.1):
+    """1-D lon/lat of the regular grid covering region at resolution (degrees)"""
+    proj = proj_defs[region]
+    lon = np.arange(proj['llcrnrlon'], proj['urcrnrlon'] + resolution / 2., resolution)
+    lat = np.arange(proj['llcrnrlat'], proj['urcrnrlat'] + resolution / 2., resolution)
+    return lon, lat
+
+
+def get_regrid_weights(region, resolution=0.1):
+    """Return the sparse matrix (target points x region cells) remapping the
+    cells of region, as selected by get_region_index, onto the regular grid
+    given by get_regrid_grid. Weights are nearest neighbour, computed from the
+    grid file only once and then cached on disk."""
+    from scipy import sparse
+    from scipy.spatial import cKDTree
+    cache_file = f"{folder}/regrid_weights_{region}_{resolution}.npz"
+    if os.path.isfile(cache_file) and \
+            os.path.getmtime(cache_file) >= os.path.getmtime(grid_file):
+        return sparse.load_npz(cache_file)
+
+    idx = get_region_index(region)
+    clon, clat = get_grid_coordinates()
+    clon, clat = clon[idx], clat[idx]
+    lon, lat = get_regrid_grid(region, resolution)
+    lon2d, lat2d = np.meshgrid(lon, lat)
+
+    tree = cKDTree(lonlat_to_xyz(clon, clat))
+    _, nearest = tree.query(lonlat_to_xyz(lon2d.ravel(), lat2d.ravel()))
+    weights = sparse.csr_matrix((np.ones(nearest.size), (np.arange(nearest.size), nearest)),
+                                shape=(nearest.size, idx.size))
+    with atomic_write(cache_file, 'wb') as f:
+        sparse.save_npz(f, weights)
+
+    return weights
+
+
+def regrid(da, region, resolution=0.1):
+    """Remap da, defined on the cells of region (i.e. read with
+    read_dataset(region=region)), onto a regular lat/lon grid so that it
+    can be plotted with contourf/pcolormesh instead of tricontourf.
+    Works on both numpy and dask arrays as long as 'cell' is not chunked,
+    and on every variable of a Dataset."""
+    if isinstance(da, xr.Dataset):
+        return da.map(regrid, args=(region, resolution), keep_attrs=True)
+    weights = get_regrid_weights(region, resolution)
+    lon, lat = get_regrid_grid(region, resolution)
+
+    def _apply_weights(values):
+        flat = values.reshape(-1, values.shape[-1])
+        out = weights.dot(flat.T).T.astype(values.dtype, copy=False)
+        return out.reshape(values.shape[:-1] + (lat.size, lon.size))
+
+    out = xr.apply_ufunc(_apply_weights, da.drop_vars(['clon', 'clat'], errors='ignore'),
+                         input_core_dims=[['cell']],
+                         output_core_dims=[['lat', 'lon']],
+                         dask='parallelized',
+                         output_dtypes=[da.dtype],
+                         dask_gufunc_kwargs={'output_sizes': {'lat': lat.size,
+                                                              'lon': lon.size}},
+                         keep_attrs=True)
+
+    return out.assign_coords(lat=lat, lon=lon)
 
 
 def get_time_run_cum(dset):
@@ -175,6 +563,60 @@ def get_time_run_cum(dset):
     return time, run, cum_hour
 
 
+def export_fields(dset, name, region, scale=0.5):
+    """Write every field of dset (probabilities in % on the cells of region,
+    as returned by the compute function of the products) to fields_folder,
+    one file of uint8 for every step with value / scale (255 where missing).
+    The coordinates of the cells are written for every region in
+    coordinates.bin (float32 lon then lat), and name.json indexes the file
+    of every field and step. Steps of the same run exported by previous
+    calls (see run_stream.py) are kept in the index. Fields with a threshold
+    dimension are written once for every threshold."""
+    out_folder = os.path.join(fields_folder, region)
+    os.makedirs(out_folder, exist_ok=True)
+
+    # Rewritten whenever it doesn't match the cells of the region or the grid changed
+    coords_file = os.path.join(out_folder, 'coordinates.bin')
+    n_cells = dset.sizes['cell']
+    if not os.path.isfile(coords_file) or \
+            os.path.getsize(coords_file) != 2 * n_cells * np.dtype(np.float32).itemsize or \
+            os.path.getmtime(coords_file) < os.path.getmtime(grid_file):
+        coords = np.concatenate([dset['clon'].values, dset['clat'].values]).astype(np.float32)
+        with atomic_write(coords_file, 'wb') as f:
+            coords.tofile(f)
+
+    time, run, cum_hour = get_time_run_cum(dset)
+    index_file = os.path.join(out_folder, name + '.json')
+    index = {'run': str(run), 'cells': n_cells, 'coordinates': 'coordinates.bin',
+             'scale': scale, 'missing': 255, 'fields': {}}
+    if os.path.isfile(index_file):
+        with open(index_file) as f:
+            old_index = json.load(f)
+        if old_index['run'] == index['run'] and old_index['cells'] == n_cells:
+            index['fields'] = old_index['fields']
+
+    for var in dset.data_vars:
+        da = dset[var]
+        if 'threshold' in da.dims:
+            fields = {'%s_%s' % (name, t): da.sel(threshold=t) for t in da['threshold'].values}
+        else:
+            fields = {name if var == 'prob' else var: da}
+        for field, values in fields.items():
+            values = values.transpose('step', 'cell').values
+            quantized = np.where(np.isnan(values), 255,
+                                 np.clip(np.round(values / scale), 0, 254)).astype(np.uint8)
+            steps = {step['hour']: step for step in index['fields'].get(field, [])}
+            for i, hour in enumerate(np.atleast_1d(cum_hour)):
+                filename = '%s_%s.bin' % (field, hour)
+                quantized[i].tofile(os.path.join(out_folder, filename))
+                steps[int(hour)] = {'hour': int(hour), 'valid_time': str(np.atleast_1d(time)[i]),
+                                    'file': filename}
+            index['fields'][field] = [steps[hour] for hour in sorted(steps)]
+
+    with atomic_write(index_file, 'w') as f:
+        json.dump(index, f)
+
+
 def print_message(message):
     """Formatted print"""
     print(os.path.basename(sys.argv[0])+' : '+message)
@@ -189,6 +631,10 @@ def get_coordinates(ds):
     elif ('clat' in ds.variables.keys()) and ('clon' in ds.variables.keys()):
         longitude = ds['clon']
         latitude = ds['clat']
+    elif ('lat' in ds.variables.keys()) and ('lon' in ds.variables.keys()):
+        # Regular grid (see regrid), return 2-D arrays shaped as (lat, lon)
+        longitude, latitude = xr.broadcast(ds['lon'], ds['lat'])
+        longitude, latitude = longitude.T, latitude.T
 
     if longitude.max() > 180:
         longitude = (((longitude.lon + 180) % 360) - 180)
@@ -196,65 +642,118 @@ def get_coordinates(ds):
     return longitude.values, latitude.values
 
 
-def get_city_coordinates(city):
-    # First read the local cache and see if we already downloaded the city coordinates
-    if os.path.isfile(home_folder + '/plotting/cities_coordinates.csv'):
-        cities_coords = pd.read_csv(home_folder + '/plotting/cities_coordinates.csv',
-                                    index_col=[0])
-        if city in cities_coords.index:
-            return cities_coords.loc[city].lon, cities_coords.loc[city].lat
-        else:
-            # make the request and append to the file
-            url = "%s/%s.json?&access_token=%s" % (apiURL_places, city, apiKey)
-            response = requests.get(url)
-            json_data = json.loads(response.text)
-            lon, lat = json_data['features'][0]['center']
-            to_append = pd.DataFrame(index=[city],
-                                     data={'lon': lon, 'lat': lat})
-            to_append.to_csv(home_folder + '/plotting/cities_coordinates.csv',
-                             mode='a', header=False)
-
-            return lon, lat
-    else:
-        # Make request and create the file for the first time
-        url = "%s/%s.json?&access_token=%s" % (apiURL_places, city, apiKey)
-        response = requests.get(url)
-        json_data = json.loads(response.text)
-        lon, lat = json_data['features'][0]['center']
-        cities_coords = pd.DataFrame(index=[city],
-                                     data={'lon': lon, 'lat': lat})
-        cities_coords.to_csv(home_folder + '/plotting/cities_coordinates.csv')
+# Local cache of the coordinates of the cities, see get_cities_coordinates
+cities_file = home_folder + '/plotting/cities_coordinates.csv'
+_cities_coordinates = None
+_geocoding_session = None
+
+
+def load_cities_coordinates():
+    """Return the dict city -> (lon, lat) of cities_file, read only once"""
+    global _cities_coordinates
+    if _cities_coordinates is None:
+        _cities_coordinates = {}
+        if os.path.isfile(cities_file):
+            coords = pd.read_csv(cities_file, index_col=[0])
+            for city, row in coords.iterrows():
+                _cities_coordinates[city] = (row['lon'], row['lat'])
+    return _cities_coordinates
+
+
+def geocode_mapbox(city):
+    """Resolve the coordinates of city with the Mapbox geocoding API"""
+    global _geocoding_session
+    if apiKey is None:
+        raise RuntimeError('MAPBOX_KEY needs to be defined to geocode %s' % city)
+    if _geocoding_session is None:
+        from requests.adapters import HTTPAdapter
+        _geocoding_session = requests.Session()
+        _geocoding_session.mount('https://', HTTPAdapter(pool_maxsize=8))
+    url = "%s/%s.json" % (apiURL_places, city)
+    response = _geocoding_session.get(url, params={'access_token': apiKey}, timeout=30)
+    response.raise_for_status()
+    lon, lat = response.json()['features'][0]['center']
+
+    return lon, lat
+
+
+def get_cities_coordinates(cities, resolver=geocode_mapbox, max_workers=8):
+    """Return the (lon, lat) of every city in cities. The ones not found in
+    cities_file are resolved concurrently with resolver (a function of
+    the city returning lon, lat) and then added to the file, which is
+    rewritten under a lock as many processes can get here at the same time."""
+    import fcntl
+    from concurrent.futures import ThreadPoolExecutor
+    coords = load_cities_coordinates()
+    missing = list(dict.fromkeys(city for city in cities if city not in coords))
+    if missing:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            resolved = dict(zip(missing, executor.map(resolver, missing)))
+        with open(cities_file + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Keep the cities added by other processes in the meantime
+            if os.path.isfile(cities_file):
+                cities_coords = pd.read_csv(cities_file, index_col=[0])
+            else:
+                cities_coords = pd.DataFrame(columns=['lon', 'lat'])
+            new_coords = pd.DataFrame.from_dict(resolved, orient='index', columns=['lon', 'lat'])
+            cities_coords = pd.concat([cities_coords,
+                                       new_coords[~new_coords.index.isin(cities_coords.index)]])
+            with atomic_write(cities_file) as f:
+                cities_coords.to_csv(f)
+        coords.update(resolved)
+
+    return [coords[city] for city in cities]
+
+
+def get_city_coordinates(city, resolver=geocode_mapbox):
+    """Return lon, lat of a single city, see get_cities_coordinates"""
+    return get_cities_coordinates([city], resolver=resolver)[0]
+
+
+# Shapefiles with the administrative boundaries drawn on the regional projections
+shapefiles = {
+    'de': 'DEU_adm/DEU_adm1',
+    'it': 'ITA_adm/ITA_adm1',
+    'nord': 'DEU_adm/DEU_adm1'
+}
 
-        return lon, lat
 
+def get_basemap(projection="euratl"):
+    """Return the Basemap instance for projection. This is built only once
+    and then pickled on disk, together with the projected geometry of the
+    shapefile read for this projection (attribute named as the shapefile)."""
+    proj_options = proj_defs[projection]
+    key = hashlib.sha1((repr(sorted(proj_options.items())) +
+                        shapefiles.get(projection, '')).encode()).hexdigest()[:12]
+    cache_file = f"{folder}/basemap_{projection}_{key}.pickle"
+    if os.path.isfile(cache_file):
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
 
-def get_projection(dset, projection="euratl", countries=True, labels=True, regions=True):
-    lon, lat = get_coordinates(dset)
     from mpl_toolkits.basemap import Basemap  # import Basemap matplotlib toolkit
-    proj_options = proj_defs[projection]
     m = Basemap(**proj_options)
-    if projection == "de":
-        if regions:
-            m.readshapefile(home_folder + '/plotting/shapefiles/DEU_adm/DEU_adm1',
-                            'DEU_adm1', linewidth=0.2, color='black', zorder=5)
-        if labels:
-            m.drawparallels(np.arange(-80., 81., 2), linewidth=0.2, color='white',
-                            labels=[True, False, False, True], fontsize=7)
-            m.drawmeridians(np.arange(-180., 181., 2), linewidth=0.2, color='white',
-                            labels=[True, False, False, True], fontsize=7)
-    elif projection == "it":
-        if regions:
-            m.readshapefile(home_folder + '/plotting/shapefiles/ITA_adm/ITA_adm1',
-                            'ITA_adm1', linewidth=0.2, color='black', zorder=5)
-        if labels:
-            m.drawparallels(np.arange(-80., 81., 2), linewidth=0.2, color='white',
-                            labels=[True, False, False, True], fontsize=7)
-            m.drawmeridians(np.arange(-180., 181., 2), linewidth=0.2, color='white',
-                            labels=[True, False, False, True], fontsize=7)
-    elif projection == "nord":
+    if projection in shapefiles:
+        shapefile = shapefiles[projection]
+        m.readshapefile(home_folder + '/plotting/shapefiles/' + shapefile,
+                        os.path.basename(shapefile), drawbounds=False)
+    with atomic_write(cache_file, 'wb') as f:
+        pickle.dump(m, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    return m
+
+
+def get_projection(dset, projection="euratl", countries=True, labels=True, regions=True):
+    lon, lat = get_coordinates(dset)
+    from matplotlib.collections import LineCollection
+    m = get_basemap(projection)
+    ax = m._check_ax()
+    if projection in shapefiles:
         if regions:
-            m.readshapefile(home_folder + '/plotting/shapefiles/DEU_adm/DEU_adm1',
-                            'DEU_adm1', linewidth=0.2, color='black', zorder=5)
+            # Segments are already projected in the cached instance
+            segments = getattr(m, os.path.basename(shapefiles[projection]))
+            ax.add_collection(LineCollection(segments, linewidth=0.2,
+                                             color='black', zorder=5))
         if labels:
             m.drawparallels(np.arange(-80., 81., 2), linewidth=0.2, color='white',
                             labels=[True, False, False, True], fontsize=7)
@@ -271,6 +770,296 @@ def get_projection(dset, projection="euratl", countries=True, labels=True, regio
     return (m, x, y)
 
 
+def get_triangulation(x, y, projection):
+    """Return the Triangulation of the projected points x, y to be passed
+    to tricontourf. As the grid is fixed the Delaunay triangles (and mask)
+    are computed only once for every projection and set of points and
+    then cached on disk, so that all scripts and workers can reuse them.
+    Points of a regular grid (2-D x, y, see regrid) need no triangulation
+    and are returned as they are, to be used by contourf."""
+    import matplotlib.tri as mtri
+    if np.ndim(x) == 2:
+        return x, y
+    x, y = np.ascontiguousarray(x), np.ascontiguousarray(y)
+    key = hashlib.sha1(x.tobytes() + y.tobytes()).hexdigest()[:12]
+    cache_file = f"{folder}/triangulation_{projection}_{key}.npz"
+    if os.path.isfile(cache_file):
+        cached = np.load(cache_file)
+        mask = cached['mask'] if 'mask' in cached.files else None
+        return mtri.Triangulation(x, y, cached['triangles'], mask)
+
+    triang = mtri.Triangulation(x, y)
+    arrays = {'triangles': triang.triangles}
+    if triang.mask is not None:
+        arrays['mask'] = triang.mask
+    with atomic_write(cache_file, 'wb') as f:
+        np.savez(f, **arrays)
+
+    return triang
+
+
+def contourf(ax, triang, values, **kwargs):
+    """Filled contours of values on triang, as returned by get_triangulation:
+    tricontourf on the cells or contourf on a regular grid (see regrid)"""
+    if isinstance(triang, tuple):
+        return ax.contourf(*triang, values, **kwargs)
+    return ax.tricontourf(triang, values, **kwargs)
+
+
+class FrameRenderer():
+    """Save the frames of a figure whose background (map, filled continents,
+    colorbar, logo...) does not change between timesteps.
+    On the first call to save the figure is cropped to its tight bounding
+    box, exactly as savefig(bbox_inches='tight') does, and the static
+    background is drawn once and cached as a bitmap. Every following frame
+    only restores this bitmap and draws the artists passed to save
+    (contours, annotations), together with the static artists that lie
+    above them (coastlines, borders...), instead of doing a full savefig.
+    The result is the same as savefig pixel by pixel."""
+
+    def __init__(self, fig, pad_inches=0.1):
+        self.fig = fig
+        self.fig.set_dpi(options_savefig['dpi'])
+        self.pad_inches = pad_inches
+        self.background = None
+        self.overlay = []
+        self.first = True
+
+    def _artists(self, elements):
+        """Unpack ContourSets that are not artists themselves (older matplotlib)"""
+        artists = []
+        for element in elements:
+            if isinstance(element, Artist):
+                artists.append(element)
+            else:
+                artists.extend(element.collections)
+        return artists
+
+    def _overlay(self, artists):
+        """Static artists drawn on top of artists by savefig, i.e. the ones
+        in the same axes with a higher zorder"""
+        lowest = min(artist.get_zorder() for artist in artists)
+        overlay = []
+        for ax in set(artist.axes for artist in artists if artist.axes is not None):
+            overlay += [child for child in ax.get_children()
+                        if child.get_zorder() > lowest and child is not ax.patch
+                        and child not in artists and child.get_visible()]
+        return overlay
+
+    def _draw_order(self, artists):
+        """artists and the overlay in the same order as Axes.draw, that is
+        sorted by zorder and then by the order in which they were added"""
+        children = []
+        for ax in self.fig.axes:
+            children += ax.get_children()
+        position = {id(child): i for i, child in enumerate(children)}
+        return sorted(artists + self.overlay,
+                      key=lambda a: (a.get_zorder(), position.get(id(a), len(children))))
+
+    def render(self, elements):
+        """Draw the frame with the artists in elements and return the RGBA image"""
+        canvas = self.fig.canvas
+        artists = self._artists(elements)
+        for artist in artists:
+            artist.set_animated(True)
+
+        if self.background is None:
+            try:
+                from matplotlib._tight_bbox import adjust_bbox
+            except ImportError:
+                from matplotlib.tight_bbox import adjust_bbox
+            self.overlay = self._overlay(artists)
+            for artist in self.overlay:
+                artist.set_animated(True)
+            # Same cropping that savefig(bbox_inches='tight') applies, only kept
+            renderer = canvas.get_renderer()
+            self.fig.draw_without_rendering()
+            bbox = self.fig.get_tightbbox(renderer).padded(self.pad_inches)
+            adjust_bbox(self.fig, bbox, renderer)
+            canvas.draw()
+            self.background = canvas.copy_from_bbox(self.fig.bbox)
+        else:
+            canvas.restore_region(self.background)
+
+        for artist in self._draw_order(artists):
+            self.fig.draw_artist(artist)
+
+        return np.asarray(canvas.buffer_rgba())
+
+    def save(self, filename, elements):
+        self.first = False
+        if not blit_frames:
+            self.fig.savefig(filename, **options_savefig)
+            return
+
+        image = self.render(elements)
+        if _frames_folder is None:
+            encode_frame(image, filename)
+        else:
+            # Leave the compression to the encoders of FrameScheduler
+            fd, raw_file = tempfile.mkstemp(suffix='.npy', dir=_frames_folder)
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, image)
+            _pending_frames.append((raw_file, filename))
+
+
+def encode_frame(image, filename, compare=False):
+    """Write the RGBA image (an array or a .npy file, which is then removed)
+    to filename, quantized to a palette of 256 colours which is enough for
+    our maps. The format is given by frame_format. Returns the bytes written
+    and, if compare, the ones of the same frame as full colour PNG."""
+    from PIL import Image
+    from io import BytesIO
+    if isinstance(image, str):
+        raw_file, image = image, np.load(image)
+        os.remove(raw_file)
+    image = Image.fromarray(np.ascontiguousarray(image)).convert('RGB')
+    stats = {'bytes': 0, 'reference': None}
+    if compare:
+        buffer = BytesIO()
+        image.save(buffer, format='PNG')
+        stats['reference'] = buffer.tell()
+
+    if frame_format == 'webp':
+        filename = os.path.splitext(filename)[0] + '.webp'
+    with atomic_write(filename, 'wb') as f:
+        if frame_format == 'webp':
+            image.save(f, format='WEBP', lossless=True, method=6)
+        else:
+            image = image.quantize(colors=256, method=Image.Quantize.FASTOCTREE,
+                                   dither=Image.Dither.NONE)
+            image.save(f, format='PNG', optimize=True)
+    stats['bytes'] = os.path.getsize(filename)
+
+    return stats
+
+
+_renderers = {}
+
+
+def get_renderer(fig):
+    """Return the FrameRenderer of fig, which is kept for the whole life
+    of the process so that the background stays warm between frames."""
+    if id(fig) not in _renderers:
+        _renderers[id(fig)] = FrameRenderer(fig)
+    return _renderers[id(fig)]
+
+
+# Arguments of every product submitted to FrameScheduler, loaded only once per worker
+_worker_args = {}
+# Where the workers of FrameScheduler leave the raw frames for the encoders
+_frames_folder = None
+_pending_frames = []
+
+
+def _init_worker(frames_folder):
+    global _frames_folder
+    _frames_folder = frames_folder
+
+
+def _render_frame(job):
+    func, key, args_file, data = job
+    if key not in _worker_args:
+        with open(args_file, 'rb') as f:
+            _worker_args[key] = pickle.load(f)
+    func(data, **_worker_args[key])
+    frames = list(_pending_frames)
+    _pending_frames.clear()
+    return frames
+
+
+class FrameScheduler():
+    """Pool of plotting workers shared by all the products of a script.
+    Every step of a submitted dataset becomes a separate job which is handed
+    out to the first free worker, so that the load is balanced dynamically.
+    The arguments of a product (figure, triangulation...) are sent only once
+    to every worker and kept there, together with the FrameRenderer
+    returned by get_renderer, between frames. The rendered frames are
+    compressed by a second pool of encoders (see encode_frame), so that the
+    plotting workers never wait for the compression."""
+
+    def __init__(self, processes=processes, encoders=encode_processes):
+        self.processes = processes
+        self.encoders = encoders
+        self.pool = None
+        self.encoder = None
+        self.results = []
+        self.encoded = []
+        # Pickled arguments of every key submitted
+        self.args_files = {}
+        self.tmpdir = tempfile.mkdtemp(prefix='frames_', dir=folder)
+
+    def submit(self, func, dset, key=None, setup=None, **args):
+        """Render every step of dset with func(dset.isel(step=[i]), **args).
+        Datasets submitted again with the same key are rendered with the
+        arguments (and so the figure) sent the first time. These can also
+        be returned by setup(), which is then only called once per key.
+        Figures in args are closed here, the workers keep their own copy."""
+        if self.pool is None:
+            self.pool = Pool(self.processes, initializer=_init_worker, initargs=(self.tmpdir,))
+            self.encoder = Pool(self.encoders)
+        if key is None:
+            key = len(self.args_files)
+        if key not in self.args_files:
+            if setup is not None:
+                args = setup()
+            args_file = os.path.join(self.tmpdir, '%d.pickle' % len(self.args_files))
+            with open(args_file, 'wb') as f:
+                pickle.dump(args, f, protocol=pickle.HIGHEST_PROTOCOL)
+            self.args_files[key] = args_file
+            import matplotlib.pyplot as plt
+            from matplotlib.axes import Axes
+            for figure in set(arg.figure for arg in args.values() if isinstance(arg, Axes)):
+                plt.close(figure)
+        args_file = self.args_files[key]
+        for i in range(len(dset.step)):
+            job = (func, key, args_file, dset.isel(step=[i]))
+            self.results.append(self.pool.apply_async(_render_frame, (job,),
+                                                      callback=self._encode))
+
+    def _encode(self, frames):
+        # Called in the main process as soon as a frame is rendered
+        for raw_file, filename in frames:
+            compare = frame_compare_every > 0 and len(self.encoded) % frame_compare_every == 0
+            self.encoded.append(self.encoder.apply_async(encode_frame, (raw_file, filename, compare)))
+
+    def wait(self):
+        """Block until all the submitted frames are rendered and written"""
+        for result in self.results:
+            result.get()
+        stats = [result.get() for result in self.encoded]
+        self.results, self.encoded = [], []
+        if stats:
+            written = sum(s['bytes'] for s in stats)
+            message = 'Wrote %d frames, %.1f MB' % (len(stats), written / 1e6)
+            sampled = [s for s in stats if s['reference'] is not None]
+            if sampled:
+                # Estimated from the frames also encoded as full colour PNG
+                ratio = sum(s['bytes'] for s in sampled) / sum(s['reference'] for s in sampled)
+                message += ', ~%.1f MB (%.0f%%) saved over full colour PNG (%d frames sampled)' % (
+                    written * (1 / ratio - 1) / 1e6, 100 * (1 - ratio), len(sampled))
+            print_message(message)
+
+    def close(self):
+        self.wait()
+        for pool in (self.pool, self.encoder):
+            if pool is not None:
+                pool.close()
+                pool.join()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is not None and self.pool is not None:
+            self.pool.terminate()
+            self.encoder.terminate()
+            self.pool, self.encoder = None, None
+            self.results, self.encoded = [], []
+        self.close()
+
+
 def chunks_dataset(ds, n):
     """Same as 'chunks' but for the time dimension in
     a dataset"""
@@ -485,6 +1274,34 @@ def add_vals_on_map(ax, projection, var, levels, density=50,
     return at
 
 
+def accumulated_to_rate(da, dim='step', unit='h'):
+    """Convert da, accumulated since the start of the run, to the mean
+    rate (per unit of time) over the interval ending at every step, i.e.
+    the backward difference between consecutive steps divided by their
+    actual spacing. The first step is divided by its own lead time (0 at
+    the start of the run). Only two consecutive steps are needed at a time:
+    every dask chunk depends on its predecessor only, while in-memory
+    arrays are converted one step at a time."""
+    hours = da[dim].values / np.timedelta64(1, unit)
+    intervals = np.diff(hours, prepend=0)
+
+    if da.chunks is not None:
+        previous = da.shift({dim: 1}, fill_value=0)
+        interval = xr.DataArray(intervals, dims=dim, coords={dim: da[dim]})
+        rate = ((da - previous) / interval.where(interval > 0)).where(interval > 0, 0)
+        return rate.transpose(*da.dims)
+
+    axis = da.get_axis_num(dim)
+    values = np.moveaxis(da.values, axis, 0)
+    out = np.empty(values.shape, dtype=np.result_type(values.dtype, np.float32))
+    previous = 0
+    for i, interval in enumerate(intervals):
+        out[i] = (values[i] - previous) / interval if interval > 0 else 0
+        previous = values[i]
+
+    return xr.DataArray(np.moveaxis(out, 0, axis), dims=da.dims, coords=da.coords, name=da.name)
+
+
 def compute_rate(dset):
     '''Given an accumulated variable compute the step rate'''
     try:
@@ -496,8 +1313,8 @@ def compute_rate(dset):
     except:
         snow_acc = dset['lssrwe']
 
-    rain = rain_acc.differentiate(coord="step", datetime_unit="h")
-    snow = snow_acc.differentiate(coord="step", datetime_unit="h")
+    rain = accumulated_to_rate(rain_acc)
+    snow = accumulated_to_rate(snow_acc)
 
     rain = xr.DataArray(rain, name='rain_rate')
     snow = xr.DataArray(snow, name='snow_rate')
@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# The plotting scripts import utils as a top level module and read their
+# folders from the environment when imported
+os.environ.setdefault('MODEL_DATA_FOLDER', tempfile.mkdtemp(prefix='icon_eu_eps_') + '/')
+os.environ.setdefault('HOME_FOLDER', os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.environ['HOME_FOLDER'], 'plotting'))
+sys.path.insert(0, os.environ['HOME_FOLDER'])
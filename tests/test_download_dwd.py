@@ -0,0 +1,102 @@
+import bz2
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import download_dwd
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Serve server.files (path -> body), sending only the first half of the
+    body (with the full Content-Length) of the paths in server.truncated"""
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        body = self.server.files.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.path in self.server.truncated:
+            body = body[:len(body) // 2]
+            self.close_connection = True
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    """Local stand-in of the DWD open data server, returns (server, base url)"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.files, server.truncated, server.requests = {}, set(), []
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.1},
+                              daemon=True)
+    thread.start()
+    yield server, 'http://127.0.0.1:%d' % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(download_dwd.time, 'sleep', lambda seconds: None)
+
+
+def make_downloader(folder, **kwargs):
+    return download_dwd.Downloader(output_folder=str(folder), **kwargs)
+
+
+def test_multistream_bz2(http_server, tmp_path):
+    server, url = http_server
+    parts = [os.urandom(5000), b'GRIB' * 3000]
+    # Chunks smaller than the streams, so that one ends in the middle of a chunk
+    server.files['/multi.grib2.bz2'] = b''.join(bz2.compress(part) for part in parts)
+    downloader = make_downloader(tmp_path, chunk_size=1000)
+
+    stats = downloader.download([url + '/multi.grib2.bz2'])
+
+    assert stats[0]['status'] == 'ok'
+    assert (tmp_path / 'multi.grib2').read_bytes() == b''.join(parts)
+
+
+def test_truncated_response(http_server, tmp_path):
+    server, url = http_server
+    server.files['/short.grib2.bz2'] = bz2.compress(os.urandom(20000))
+    server.truncated.add('/short.grib2.bz2')
+    downloader = make_downloader(tmp_path, max_retries=2)
+
+    stats = downloader.download([url + '/short.grib2.bz2'])
+
+    assert stats[0]['status'] == 'failed'
+    assert stats[0]['attempts'] == 2
+    assert server.requests.count('/short.grib2.bz2') == 2
+    # Neither a partial file nor one that looks complete is left behind
+    assert os.listdir(tmp_path) == []
+
+
+def test_resume_after_partial_failure(http_server, tmp_path):
+    server, url = http_server
+    data = {name: os.urandom(10000) for name in ('a.grib2', 'b.grib2')}
+    for name, content in data.items():
+        server.files['/%s.bz2' % name] = bz2.compress(content)
+    server.truncated.add('/b.grib2.bz2')
+    urls = [url + '/a.grib2.bz2', url + '/b.grib2.bz2']
+
+    stats = make_downloader(tmp_path, max_retries=2).download(urls)
+    assert [s['status'] for s in stats] == ['ok', 'failed']
+    assert sorted(os.listdir(tmp_path)) == ['a.grib2']
+
+    # A new call only downloads the file still missing
+    server.truncated.clear()
+    server.requests.clear()
+    stats = make_downloader(tmp_path, max_retries=2).download(urls)
+    assert [s['status'] for s in stats] == ['skipped', 'ok']
+    assert server.requests == ['/b.grib2.bz2']
+    for name, content in data.items():
+        assert (tmp_path / name).read_bytes() == content
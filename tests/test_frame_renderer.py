@@ -0,0 +1,58 @@
+import io
+import numpy as np
+import pytest
+
+matplotlib = pytest.importorskip('matplotlib')
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+from matplotlib.image import imread
+from matplotlib.tri import Triangulation
+
+utils = pytest.importorskip('utils')
+
+rng = np.random.default_rng(0)
+x, y = rng.uniform(0, 10, 500), rng.uniform(0, 8, 500)
+triang = Triangulation(x, y)
+
+
+def make_figure():
+    """Map-like figure: background below the fields, borders above them"""
+    fig = plt.figure(figsize=(utils.figsize_x, utils.figsize_y))
+    ax = plt.gca()
+    ax.fill([0, 10, 10, 0], [0, 0, 4, 4], color='lightgray', zorder=0)
+    ax.add_collection(LineCollection([[(0, 0), (10, 8)], [(0, 8), (10, 0)]],
+                                     color='black', linewidth=0.5, zorder=5))
+    return fig, ax
+
+
+def draw_frame(ax, step, first):
+    cs = ax.tricontourf(triang, np.sin(x + step) * np.cos(y), levels=10)
+    an_fc = utils.annotation(ax, 'step %d' % step, loc='upper left')
+    if first:
+        ax.figure.colorbar(cs, ax=ax, orientation='horizontal', fraction=0.04, pad=0.04)
+    return [cs, an_fc]
+
+
+def savefig_frame(step):
+    fig, ax = make_figure()
+    draw_frame(ax, step, first=True)
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', **utils.options_savefig)
+    plt.close(fig)
+    buffer.seek(0)
+    return (imread(buffer) * 255).round().astype(np.uint8)
+
+
+def test_blitted_frames_match_savefig():
+    fig, ax = make_figure()
+    renderer = utils.FrameRenderer(fig)
+    for step in range(3):
+        elements = draw_frame(ax, step, first=step == 0)
+        image = renderer.render(elements).copy()
+        utils.remove_collections(elements)
+
+        expected = savefig_frame(step)
+        assert image.shape == expected.shape
+        np.testing.assert_array_equal(image, expected)
+    plt.close(fig)
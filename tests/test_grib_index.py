@@ -0,0 +1,60 @@
+import os
+
+import utils
+
+
+def test_index_rebuilt_when_older_than_file(tmp_path, monkeypatch):
+    """A file downloaded again with the same size and ends (hence the same
+    index name) must not be read with the index of the previous one"""
+    built = []
+
+    def open_dataset(file, engine, backend_kwargs):
+        # Stand-in for cfgrib, which writes the index while opening file
+        built.append(file)
+        with open(backend_kwargs['indexpath'], 'w') as f:
+            f.write('index')
+        return type('Dataset', (), {'close': lambda self: None})()
+
+    monkeypatch.setattr(utils.xr, 'open_dataset', open_dataset)
+    monkeypatch.setattr(utils, 'index_folder', str(tmp_path / 'grib_index') + '/')
+    grib_file = tmp_path / 'file.grib2'
+    grib_file.write_bytes(b'GRIB' * 100)
+
+    index_file = utils.build_grib_index(grib_file)
+    assert utils.build_grib_index(grib_file) == index_file
+    assert len(built) == 1
+
+    # Same content written again after the index
+    mtime = os.path.getmtime(grib_file)
+    os.utime(index_file, (mtime - 10, mtime - 10))
+    assert utils.build_grib_index(grib_file) == index_file
+    assert len(built) == 2
+    assert os.path.getmtime(index_file) >= os.path.getmtime(grib_file)
+
+
+def test_read_grib_keeps_members_first(tmp_path, monkeypatch):
+    """Files of a single step are concatenated as (number, step, values),
+    the layout of the files merged over time"""
+    import numpy as np
+    import pandas as pd
+    files = []
+    for i in range(3):
+        files.append(tmp_path / ('step_%d_tot_prec.grib2' % i))
+        files[-1].write_bytes(b'GRIB')
+
+    def open_dataset(file, engine, chunks, backend_kwargs):
+        # Stand-in for cfgrib on a file with a single step
+        step = int(os.path.basename(file).split('_')[1])
+        return utils.xr.Dataset({'tp': (('number', 'values'), np.full((4, 10), step))},
+                                coords={'step': pd.Timedelta(hours=step),
+                                        'valid_time': pd.Timestamp('2026-01-01') +
+                                        pd.Timedelta(hours=step)})
+
+    monkeypatch.setattr(utils.xr, 'open_dataset', open_dataset)
+    monkeypatch.setattr(utils, 'build_grib_index', lambda file: file + '.idx')
+
+    dset = utils.read_grib('tot_prec', files=[str(f) for f in files])
+
+    assert dset['tp'].dims == ('number', 'step', 'values')
+    assert dset['valid_time'].dims == ('step',)
+    assert (dset['tp'].isel(number=0, values=0).values == [0, 1, 2]).all()
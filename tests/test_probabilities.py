@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+import utils
+
+
+@pytest.mark.parametrize('chunked', [False, True])
+def test_compute_probabilities(chunked):
+    rng = np.random.default_rng(0)
+    values = rng.gamma(1., 2., size=(40, 3, 50))
+    values[rng.random(values.shape) < 0.05] = np.nan
+    da = xr.DataArray(values, dims=('number', 'step', 'cell'))
+    if chunked:
+        da = da.chunk({'number': -1, 'step': 1, 'cell': 25})
+
+    out = utils.compute_probabilities(da, [1, 5], percentiles=[10, 90], mean=True)
+
+    assert set(out.data_vars) == {'prob', 'mean', 'percentiles'}
+    np.testing.assert_allclose(out['prob'].sel(threshold=5).values,
+                               (values > 5).mean(axis=0) * 100)
+    np.testing.assert_allclose(out['percentiles'].sel(percentile=90).values,
+                               np.nanpercentile(values, 90, axis=0))
+    np.testing.assert_allclose(out['percentiles'].transpose('percentile', ...).values,
+                               np.nanpercentile(values, [10, 90], axis=0))
+    np.testing.assert_allclose(out['mean'].values, np.nanmean(values, axis=0))
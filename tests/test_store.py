@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+pytest.importorskip('zarr')
+import utils
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store_file = str(tmp_path / 'icon_eu_eps.zarr')
+    monkeypatch.setattr(utils, 'store_file', store_file)
+    monkeypatch.setattr(utils, 'folder', str(tmp_path) + '/')
+    return store_file
+
+
+def test_open_converted_variable(store):
+    dset = xr.Dataset({'tp': (('number', 'step', 'values'),
+                              np.random.rand(4, 3, 10).astype(np.float32))})
+    dset.to_zarr(store, group='tot_prec', mode='w',
+                 encoding=utils.store_encoding(dset.data_vars), consolidated=True)
+
+    assert utils.in_store('tot_prec')
+    opened = utils.open_variable('tot_prec')
+    np.testing.assert_array_equal(opened['tp'].values, dset['tp'].values)
+
+
+def test_failed_conversion_is_not_trusted(store):
+    """A write that fails on the encoding leaves an empty group behind"""
+    dset = xr.Dataset({'tp': (('number', 'step', 'values'), np.zeros((4, 3, 10)))})
+    with pytest.raises(ValueError):
+        dset.to_zarr(store, group='tot_prec', mode='w',
+                     encoding={'tp': {'unknown': None}}, consolidated=True)
+
+    assert not utils.in_store('tot_prec')
+    # Falls back to the (here missing) GRIB files
+    with pytest.raises(OSError):
+        utils.open_variable('tot_prec')
@@ -0,0 +1,87 @@
+import os
+import threading
+import pytest
+
+pytest.importorskip('pyftpdlib')
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import FTPServer
+
+import upload_ftp
+
+
+@pytest.fixture
+def ftp_server(tmp_path):
+    """Local FTP server writing to tmp_path/remote, returns (host, port, root)"""
+    root = tmp_path / 'remote'
+    root.mkdir()
+    authorizer = DummyAuthorizer()
+    authorizer.add_user('user', 'password', str(root), perm='elradfmw')
+    handler = type('Handler', (FTPHandler,), {'authorizer': authorizer})
+    server = FTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, kwargs={'timeout': 0.1}, daemon=True)
+    thread.start()
+    yield server.address[0], server.address[1], root
+    server.close_all()
+
+
+@pytest.fixture
+def images(tmp_path):
+    local = tmp_path / 'local'
+    (local / 'it').mkdir(parents=True)
+    for hour in (0, 1, 2):
+        (local / ('prob_clouds_%d.png' % hour)).write_bytes(b'euratl %d' % hour)
+        (local / 'it' / ('prob_clouds_%d.png' % hour)).write_bytes(b'it %d' % hour)
+    return local
+
+
+def make_uploader(ftp_server, tmp_path, **kwargs):
+    host, port, _ = ftp_server
+    return upload_ftp.Uploader(host, 'user', 'password', port, max_connections=2,
+                               manifest_file=str(tmp_path / 'manifest.json'), **kwargs)
+
+
+def groups(local):
+    return ['icon_eu_eps/prob_clouds=%s/prob_clouds_*' % local,
+            'icon_eu_eps/it/prob_clouds=%s/it/prob_clouds_*' % local]
+
+
+def test_upload_and_skip_unchanged(ftp_server, tmp_path, images):
+    _, _, root = ftp_server
+    uploader = make_uploader(ftp_server, tmp_path)
+    stats = uploader.upload_many(upload_ftp.find_files(groups(images)))
+    uploader.close()
+    assert [s['status'] for s in stats] == ['ok'] * 6
+    assert (root / 'icon_eu_eps' / 'it' / 'prob_clouds' / 'prob_clouds_1.png').read_bytes() == b'it 1'
+
+    # A new run with only one changed frame uploads only that one
+    (images / 'prob_clouds_2.png').write_bytes(b'changed')
+    uploader = make_uploader(ftp_server, tmp_path)
+    stats = uploader.upload_many(upload_ftp.find_files(groups(images)))
+    uploader.close()
+    assert sorted(s['file'] for s in stats if s['status'] == 'ok') == [str(images / 'prob_clouds_2.png')]
+    assert sum(s['status'] == 'skipped' for s in stats) == 5
+    assert (root / 'icon_eu_eps' / 'prob_clouds' / 'prob_clouds_2.png').read_bytes() == b'changed'
+
+
+def test_watch_retries_failed_files(ftp_server, tmp_path, images):
+    _, _, root = ftp_server
+    uploader = make_uploader(ftp_server, tmp_path, max_retries=1)
+    until = tmp_path / 'plotting_done'
+    upload_once = uploader._upload_once
+    failures = []
+
+    def flaky_upload(filename, remote):
+        # The first attempt of one file fails, then plotting finishes
+        if filename.endswith('prob_clouds_0.png') and not failures:
+            failures.append(filename)
+            raise ConnectionResetError('connection lost')
+        until.touch()
+        return upload_once(filename, remote)
+
+    uploader._upload_once = flaky_upload
+    stats = uploader.watch(groups(images), str(until), poll_interval=0.1, settle=0)
+    uploader.close()
+    assert failures
+    assert [s['status'] for s in stats].count('ok') == 6
+    assert (root / 'icon_eu_eps' / 'prob_clouds' / 'prob_clouds_0.png').read_bytes() == b'euratl 0'
@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+import utils
+
+
+@pytest.fixture
+def cities_file(tmp_path, monkeypatch):
+    cities_file = tmp_path / 'cities_coordinates.csv'
+    pd.DataFrame({'lon': [10.0], 'lat': [53.55]}, index=['Hamburg']).to_csv(cities_file)
+    monkeypatch.setattr(utils, 'cities_file', str(cities_file))
+    monkeypatch.setattr(utils, '_cities_coordinates', None)
+    return cities_file
+
+
+def test_get_cities_coordinates(cities_file, monkeypatch):
+    reads = []
+    read_csv = pd.read_csv
+    monkeypatch.setattr(utils.pd, 'read_csv', lambda *a, **k: reads.append(a) or read_csv(*a, **k))
+    resolved = []
+
+    def resolver(city):
+        resolved.append(city)
+        if city == 'Pisa':
+            # Another process adds a city while we're resolving ours
+            with open(cities_file, 'a') as f:
+                f.write('Milano,9.19,45.46\n')
+        return {'Pisa': (10.4, 43.72), 'Roma': (12.5, 41.9)}[city]
+
+    assert utils.get_cities_coordinates(['Hamburg']) == [(10.0, 53.55)]
+    assert len(reads) == 1
+
+    coords = utils.get_cities_coordinates(['Pisa', 'Hamburg', 'Roma', 'Pisa'], resolver=resolver)
+    assert coords == [(10.4, 43.72), (10.0, 53.55), (12.5, 41.9), (10.4, 43.72)]
+    # Only the misses, each once, in one batch
+    assert sorted(resolved) == ['Pisa', 'Roma']
+
+    # The cache is not read again, the file only under the lock
+    assert utils.get_cities_coordinates(['Roma', 'Hamburg']) == [(12.5, 41.9), (10.0, 53.55)]
+    assert len(reads) == 2
+    assert sorted(resolved) == ['Pisa', 'Roma']
+
+    saved = pd.read_csv(cities_file, index_col=[0])
+    assert sorted(saved.index) == ['Hamburg', 'Milano', 'Pisa', 'Roma']
+    assert tuple(saved.loc['Hamburg']) == (10.0, 53.55)
+
+
+def test_accumulated_to_rate_numpy_and_dask():
+    # Hourly, then 3-hourly and 6-hourly steps, as in f_times of get_last_run.py
+    hours = np.array(list(range(0, 49)) + list(range(51, 73, 3)) + list(range(78, 121, 6)))
+    rng = np.random.default_rng(0)
+    rates = rng.random((4, len(hours), 5))
+    intervals = np.diff(hours, prepend=0)
+    accumulated = np.cumsum(rates * intervals[None, :, None], axis=1)
+    da = xr.DataArray(accumulated, dims=('number', 'step', 'cell'),
+                      coords={'step': pd.to_timedelta(hours, 'h')})
+
+    in_memory = utils.accumulated_to_rate(da)
+    chunked = utils.accumulated_to_rate(da.chunk({'step': 1}))
+
+    assert in_memory.dims == chunked.dims == da.dims
+    expected = np.where(intervals[None, :, None] > 0, rates, 0)
+    np.testing.assert_allclose(in_memory.values, expected)
+    np.testing.assert_allclose(chunked.values, expected)
+
+
+def test_atomic_write(tmp_path):
+    path = tmp_path / 'index.json'
+    with utils.atomic_write(str(path)) as f:
+        f.write('old')
+    # A failed write leaves the previous file and nothing else
+    with pytest.raises(RuntimeError):
+        with utils.atomic_write(str(path)) as f:
+            f.write('new')
+            raise RuntimeError
+    assert path.read_text() == 'old'
+    assert [p.name for p in tmp_path.iterdir()] == ['index.json']
+
+    with utils.atomic_write(str(path), None) as tmp_file:
+        with open(tmp_file, 'w') as f:
+            f.write('new')
+        assert path.read_text() == 'old'
+    assert path.read_text() == 'new'
@@ -0,0 +1,235 @@
+import ftplib
+import netrc
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+import threading
+import argparse
+import hashlib
+import base64
+import queue
+import json
+import time
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plotting'))
+from utils import atomic_write
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('groups', nargs='+',
+                    help='Files to upload as remote_folder=local_pattern, e.g. icon_eu_eps/it=./it/prob_*')
+parser.add_argument('-b', '--bookmark', help='ncftp bookmark with the server and credentials',
+                    required=False, default=os.environ.get('NCFTP_BOOKMARK'))
+parser.add_argument('-j', '--max_connections', help='Number of concurrent FTP connections',
+                    required=False, default=5, type=int)
+parser.add_argument('-m', '--manifest', help='JSON file with the hashes of the files already uploaded',
+                    required=False, default='upload_manifest.json')
+parser.add_argument('-u', '--until', help='Keep uploading new files until this file exists',
+                    required=False, default=None)
+
+
+def read_ncftp_bookmark(name, bookmarks_file='~/.ncftp/bookmarks'):
+    """Return host, user, password and port of the ncftp bookmark name"""
+    with open(os.path.expanduser(bookmarks_file)) as f:
+        for line in f:
+            fields = line.rstrip('\n').split(',')
+            if fields[0] == name:
+                password = fields[3]
+                if password.startswith('*encoded*'):
+                    password = base64.b64decode(password[len('*encoded*'):]).decode()
+                return fields[1], fields[2], password, int(fields[7] or 21)
+    raise KeyError('Bookmark %s not found in %s' % (name, bookmarks_file))
+
+
+def get_credentials(bookmark=None):
+    """Server and credentials from the ncftp bookmark if given, otherwise from
+    FTP_HOST and FTP_USER/FTP_PASSWORD or the ~/.netrc entry of FTP_HOST"""
+    if bookmark:
+        return read_ncftp_bookmark(bookmark)
+    host = os.environ['FTP_HOST']
+    user, password = os.environ.get('FTP_USER'), os.environ.get('FTP_PASSWORD')
+    if user is None:
+        user, _, password = netrc.netrc().authenticators(host)
+    return host, user, password, int(os.environ.get('FTP_PORT', 21))
+
+
+def file_hash(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Uploader():
+    """Upload files over a pool of FTP connections which are kept open between
+    files. The hash of every uploaded file is recorded in a manifest (remote
+    path -> sha1) kept across runs, so that files identical to the ones
+    already on the server are skipped."""
+
+    def __init__(self, host, user, password, port=21, max_connections=5,
+                 manifest_file='upload_manifest.json', max_retries=3, timeout=60):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.port = port
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.manifest_file = manifest_file
+        self.manifest = {}
+        if manifest_file and os.path.isfile(manifest_file):
+            with open(manifest_file) as f:
+                self.manifest = json.load(f)
+        self._connections = queue.LifoQueue()
+        self._folders = set()
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        ftp = ftplib.FTP(timeout=self.timeout)
+        ftp.connect(self.host, self.port)
+        ftp.login(self.user, self.password)
+        return ftp
+
+    def _make_folders(self, ftp, folder):
+        """Create folder and its parents on the server, only once per run"""
+        path = ''
+        for part in folder.strip('/').split('/'):
+            path = path + '/' + part if path else part
+            if path in self._folders:
+                continue
+            try:
+                ftp.mkd(path)
+            except ftplib.error_perm:
+                # Already there
+                pass
+            with self._lock:
+                self._folders.add(path)
+
+    def _upload_once(self, filename, remote):
+        try:
+            ftp = self._connections.get_nowait()
+        except queue.Empty:
+            ftp = self._connect()
+        try:
+            self._make_folders(ftp, os.path.dirname(remote))
+            with open(filename, 'rb') as f:
+                ftp.storbinary('STOR ' + remote, f)
+        except Exception:
+            # Don't put back a connection in an unknown state
+            ftp.close()
+            raise
+        self._connections.put(ftp)
+
+    def upload(self, filename, remote):
+        """Upload filename to remote unless the same content is already there,
+        returns its statistics"""
+        digest = file_hash(filename)
+        stats = {'file': filename, 'remote': remote, 'bytes': os.path.getsize(filename)}
+        if self.manifest.get(remote) == digest:
+            stats['status'] = 'skipped'
+            return stats
+
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                self._upload_once(filename, remote)
+                with self._lock:
+                    self.manifest[remote] = digest
+                stats.update({'status': 'ok', 'attempts': attempt})
+                return stats
+            except ftplib.all_errors as e:
+                stats['error'] = str(e)
+                if attempt < self.max_retries:
+                    time.sleep(min(2 ** attempt, 30))
+
+        stats.update({'status': 'failed', 'attempts': self.max_retries})
+        return stats
+
+    def upload_many(self, files):
+        """Upload all (filename, remote) in files concurrently, returns the list of statistics"""
+        with ThreadPoolExecutor(max_workers=self.max_connections) as executor:
+            stats = list(executor.map(lambda f: self.upload(*f), files))
+        self.save_manifest()
+        return stats
+
+    def watch(self, groups, until, poll_interval=10, settle=5):
+        """Upload the files matching groups as soon as they appear (and again if
+        they change) until the file until exists, so that the upload runs
+        while the images are still being produced. Files are only taken once
+        they haven't been modified for settle seconds."""
+        uploaded = {}
+        stats = []
+        while True:
+            done = os.path.exists(until)
+            now = time.time()
+            files = []
+            for filename, remote in find_files(groups):
+                mtime = os.path.getmtime(filename)
+                if uploaded.get(filename) != mtime and (done or now - mtime >= settle):
+                    files.append((filename, remote, mtime))
+            if files:
+                new_stats = self.upload_many([(filename, remote) for filename, remote, _ in files])
+                # Failed files are tried again in the next pass
+                for (filename, _, mtime), s in zip(files, new_stats):
+                    if s['status'] != 'failed':
+                        uploaded[filename] = mtime
+                stats += new_stats
+            if done:
+                return stats
+            time.sleep(poll_interval)
+
+    def save_manifest(self):
+        if not self.manifest_file:
+            return
+        with self._lock:
+            with atomic_write(self.manifest_file) as f:
+                json.dump(self.manifest, f)
+
+    def close(self):
+        while not self._connections.empty():
+            ftp = self._connections.get_nowait()
+            try:
+                ftp.quit()
+            except ftplib.all_errors:
+                ftp.close()
+
+
+def find_files(groups):
+    """Return (filename, remote) of all the files matching groups, a list of
+    remote_folder=local_pattern"""
+    files = []
+    for group in groups:
+        remote_folder, pattern = group.split('=', 1)
+        for filename in sorted(glob(pattern)):
+            files.append((filename, remote_folder + '/' + os.path.basename(filename)))
+    return files
+
+
+def print_stats(stats):
+    for s in stats:
+        if s['status'] == 'failed':
+            print('%s : FAILED after %d attempts (%s)' % (s['file'], s['attempts'], s['error']))
+    ok = [s for s in stats if s['status'] == 'ok']
+    skipped = [s for s in stats if s['status'] == 'skipped']
+    print('Uploaded %d files (%.1f MB), skipped %d unchanged (%.1f MB), failed %d' %
+          (len(ok), sum(s['bytes'] for s in ok) / 1e6,
+           len(skipped), sum(s['bytes'] for s in skipped) / 1e6,
+           sum(s['status'] == 'failed' for s in stats)))
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    host, user, password, port = get_credentials(args.bookmark)
+    uploader = Uploader(host, user, password, port,
+                        max_connections=args.max_connections,
+                        manifest_file=args.manifest)
+    try:
+        if args.until:
+            stats = uploader.watch(args.groups, args.until)
+        else:
+            stats = uploader.upload_many(find_files(args.groups))
+    finally:
+        uploader.close()
+    print_stats(stats)
+    if any(s['status'] == 'failed' for s in stats):
+        exit(1)